@@ -0,0 +1,278 @@
+# Archive output for the extractors
+#
+# Stands in for the directory output (pipeline.Pipeline) and writes every
+# member of a run into one tar or zip file instead of a file per member, under
+# its path relative to the archive root, so an archive unpacked in the root
+# gives the same files a directory run would.
+#
+# Compressed tars are compressed in blocks by a pool of worker processes and
+# the blocks are written one after the other as separate gzip members or xz
+# streams, which gzip, xz and tarfile all read back as a single stream.
+
+import os
+import time
+import gzip
+import lzma
+import tarfile
+import zipfile
+import tempfile
+import collections
+import concurrent.futures
+
+import metrics
+
+# suffix, kind
+ARCHIVE_TYPES = (
+    (".tar.gz", "gz"),
+    (".tgz", "gz"),
+    (".tar.xz", "xz"),
+    (".txz", "xz"),
+    (".tar", "tar"),
+    (".zip", "zip"),
+)
+
+COMPRESS_BLOCK_SIZE = 4 * 1024 * 1024
+
+COMPRESS_LEVEL = 6
+
+# members that cannot go straight into the archive wait here, in memory up
+# to this size
+SPOOL_SIZE = 16 * 1024 * 1024
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+def archive_kind(path):
+    lower = path.lower()
+    for suffix, kind in ARCHIVE_TYPES:
+        if lower.endswith(suffix):
+            return kind
+    return None
+
+def compress_block(kind, data):
+    if kind == "gz":
+        return gzip.compress(data, COMPRESS_LEVEL)
+    return lzma.compress(data, format=lzma.FORMAT_XZ, preset=COMPRESS_LEVEL)
+
+class BlockCompressor:
+    # file-like; compresses what is written in fixed-size blocks, in order
+    def __init__(self, f, kind, workers=None):
+        self.f = f
+        self.kind = kind
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        self.max_pending = 2 * (workers or os.cpu_count() or 1)
+        self.pending = collections.deque()
+        self.buf = bytearray()
+
+    def write(self, data):
+        self.buf += data
+        if len(self.buf) >= COMPRESS_BLOCK_SIZE:
+            for start in range(0, len(self.buf) - COMPRESS_BLOCK_SIZE + 1, COMPRESS_BLOCK_SIZE):
+                self.submit(bytes(self.buf[start:start+COMPRESS_BLOCK_SIZE]))
+            del self.buf[:start+COMPRESS_BLOCK_SIZE]
+        return len(data)
+
+    def submit(self, block):
+        self.pending.append(self.pool.submit(compress_block, self.kind, block))
+        while len(self.pending) > self.max_pending:
+            self.f.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.buf:
+            self.submit(bytes(self.buf))
+            self.buf = bytearray()
+        while self.pending:
+            self.f.write(self.pending.popleft().result())
+        self.pool.shutdown()
+
+class TarWriter:
+    def __init__(self, f):
+        self.f = f
+        self.mtime = int(time.time())
+
+    def begin(self, name, size):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = self.mtime
+        info.mode = 0o644
+        self.f.write(info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape"))
+
+    def end(self, size):
+        if size % tarfile.BLOCKSIZE:
+            self.f.write(bytes(tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE))
+
+    def close(self, written):
+        # two empty blocks, then padding to a whole record
+        end = written + 2 * tarfile.BLOCKSIZE
+        padding = 2 * tarfile.BLOCKSIZE + (-end) % tarfile.RECORDSIZE
+        self.f.write(bytes(padding))
+
+class StreamWriter:
+    # writes a member of known size straight into the archive
+    def __init__(self, archive, name, size, timer=metrics.null_timer):
+        self.archive = archive
+        self.name = name
+        self.size = size
+        self.timer = timer
+        self.written = 0
+        if archive.zip is not None:
+            info = zipfile.ZipInfo(name, time.localtime(archive.mtime)[:6])
+            self.f = archive.zip.open(info, "w", force_zip64=size >= zipfile.ZIP64_LIMIT)
+        else:
+            archive.tar.begin(name, size)
+            self.f = archive.sink
+
+    def write(self, data):
+        if self.written + len(data) > self.size:
+            raise ValueError("more data than the %d bytes announced" % self.size)
+        self.f.write(data)
+        self.written += len(data)
+        return len(data)
+
+    def close(self):
+        if self.f is None:
+            return
+        # a tar header is out already, and padding would pass a truncated
+        # input off as a whole member
+        short = self.written < self.size
+        if self.archive.zip is not None:
+            self.f.close()
+        elif not short:
+            self.archive.tar.end(self.size)
+            self.archive.offset += tarfile.BLOCKSIZE + self.size + (-self.size) % tarfile.BLOCKSIZE
+        self.f = None
+        if short:
+            raise ValueError("%s: %d of the %d bytes announced were written" % (self.name, self.written, self.size))
+        self.timer.done()
+        self.archive.end_stream()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class SpooledWriter:
+    # collects a member that cannot be streamed (unknown size, or another
+    # member is streaming), then adds it as a whole
+    def __init__(self, archive, name, timer=metrics.null_timer):
+        self.archive = archive
+        self.name = name
+        self.timer = timer
+        self.f = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+
+    def write(self, data):
+        return self.f.write(data)
+
+    def close(self):
+        if self.f is not None:
+            f, self.f = self.f, None
+            self.archive.add_spooled(self.name, f)
+            self.timer.done()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ArchiveOutput:
+    def __init__(self, path, root, workers=None):
+        self.root = root
+        self.mtime = time.time()
+        self.file = open(path, "wb")
+        kind = archive_kind(path)
+        self.zip = None
+        self.tar = None
+        if kind == "zip":
+            self.zip = zipfile.ZipFile(self.file, "w", zipfile.ZIP_STORED, allowZip64=True)
+        elif kind in ("gz", "xz"):
+            self.sink = BlockCompressor(self.file, kind, workers)
+            self.tar = TarWriter(self.sink)
+        else:
+            self.sink = self.file
+            self.tar = TarWriter(self.sink)
+        self.offset = 0
+        self.streaming = False
+        self.draining = False
+        # (name, data or spooled file) waiting for a streaming member to end
+        self.queued = collections.deque()
+
+    def arcname(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, "/")
+
+    def open(self, path, size=None, timer=metrics.null_timer):
+        if size is None or self.streaming:
+            return SpooledWriter(self, self.arcname(path), timer)
+        return self.open_stream(self.arcname(path), size, timer)
+
+    def submit(self, path, data, timer=metrics.null_timer):
+        if self.streaming:
+            self.queued.append((self.arcname(path), bytes(data)))
+        else:
+            self.add(self.arcname(path), data)
+        timer.done()
+
+    def add(self, name, data):
+        with self.open_stream(name, len(data)) as f:
+            f.write(data)
+
+    def add_spooled(self, name, f):
+        if self.streaming:
+            self.queued.append((name, f))
+            return
+        size = f.seek(0, os.SEEK_END)
+        f.seek(0)
+        with self.open_stream(name, size) as out:
+            while True:
+                buf = f.read(COPY_CHUNK_SIZE)
+                if not buf:
+                    break
+                out.write(buf)
+        f.close()
+
+    def open_stream(self, name, size, timer=metrics.null_timer):
+        self.streaming = True
+        return StreamWriter(self, name, size, timer)
+
+    def end_stream(self):
+        self.streaming = False
+        # members added from here end their streams back in here
+        if self.draining:
+            return
+        self.draining = True
+        try:
+            while self.queued and not self.streaming:
+                name, data = self.queued.popleft()
+                if isinstance(data, bytes):
+                    self.add(name, data)
+                else:
+                    self.add_spooled(name, data)
+        finally:
+            self.draining = False
+
+    def wait(self):
+        # members are in the archive as soon as they are handed over
+        pass
+
+    def close(self):
+        if self.file is None:
+            return
+        if self.zip is not None:
+            self.zip.close()
+        else:
+            self.tar.close(self.offset)
+            if self.sink is not self.file:
+                self.sink.close()
+        self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_output(path, root, workers=None):
+    if archive_kind(path) is None:
+        raise ValueError("Unsupported archive type: %s (use .tar, .tar.gz, .tgz, .tar.xz, .txz or .zip)" % path)
+    return ArchiveOutput(path, root, workers)
@@ -0,0 +1,306 @@
+# Synthetic input generators for the extractor benchmarks
+#
+# Every generator writes a structurally valid input of roughly the requested
+# size, streaming the payload so that inputs of several gigabytes can be made
+# without holding them in memory. The payload bytes never contain a chunk
+# magic, so the extractors see exactly the chunks the generator laid out.
+
+import os
+import sys
+import struct
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+USAGE = """Usage: %s [-s <size>] [-r <seed>] <output_dir> [<format> ...]
+
+  -s  approximate size of each input, with an optional K, M or G suffix
+      (default: 16M)
+  -r  seed for the payload bytes (default: 1)
+
+Formats: %s"""
+
+SECTOR_SIZE = 2048
+
+FILLER_SIZE = 0x100000
+
+# first letters of every chunk magic the extractors look for
+MAGIC_BYTES = b"KTPpSIE"
+
+class Filler:
+    def __init__(self, seed):
+        rng = random.Random(seed)
+        pool = bytearray(rng.getrandbits(8 * FILLER_SIZE).to_bytes(FILLER_SIZE, "little"))
+        for byte in MAGIC_BYTES:
+            pool = pool.replace(bytes([byte]), b"\x00")
+        # doubled, so any FILLER_SIZE window of it is one slice
+        self.pool = bytes(pool) * 2
+        self.pos = 0
+
+    def write(self, f, size):
+        while size > 0:
+            n = min(size, FILLER_SIZE)
+            f.write(self.pool[self.pos:self.pos+n])
+            # successive members start at different places in the pool
+            self.pos = (self.pos + n + 0x1F3) % FILLER_SIZE
+            size -= n
+
+def align(x, alignment):
+    return (x + alignment - 1) & ~(alignment - 1)
+
+def write_zeros(f, count):
+    if count > 0:
+        f.seek(count, os.SEEK_CUR)
+
+def finish(f):
+    # a trailing seek leaves no bytes behind unless something is written
+    f.truncate(f.tell())
+
+def parse_size(s):
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    if s[-1:].upper() in units:
+        return int(float(s[:-1]) * units[s[-1].upper()])
+    return int(s)
+
+# Elder Gate SDD: KCET > TSDB > KDT2 > KDT1 sequences and one PBAV
+
+SDD_KDT_SIZE = 0x10000
+SDD_KDT_PER_TSDB = 8
+SDD_NUM_PROGRAMS = 64
+
+def write_pbav(f, filler, body_size):
+    tone_table = bytearray(SDD_NUM_PROGRAMS * 0x200)
+    rng = random.Random(len(tone_table))
+    for program in range(SDD_NUM_PROGRAMS):
+        num_tones = rng.randrange(1, 17)
+        for tone in range(16):
+            offset = program * 0x200 + tone * 0x20
+            tone_table[offset+0x02] = rng.randrange(128)
+            tone_table[offset+0x03] = rng.randrange(128)
+            struct.pack_into("<H", tone_table, offset+0x16, rng.randrange(1, 256) if tone < num_tones else 0)
+    size = 0x20 + len(tone_table) + body_size
+    header = bytearray(0x20)
+    header[0x00:0x04] = b"PBAV"
+    struct.pack_into("<I", header, 0x0C, size)
+    struct.pack_into("<H", header, 0x12, SDD_NUM_PROGRAMS)
+    f.write(header)
+    f.write(tone_table)
+    filler.write(f, body_size)
+
+def gen_sdd(outdir, size, filler):
+    path = os.path.join(outdir, "BENCH.SDD")
+    kdt2_size = 0x10 + 0x08 + SDD_KDT_SIZE
+    tsdb_size = 0x08 + 0x0C + SDD_KDT_PER_TSDB * kdt2_size
+    num_kcet = max(1, (size * 3 // 4) // tsdb_size)
+    with open(path, "wb") as f:
+        f.write(bytes(0x40))
+        seq_num = 0
+        for i in range(num_kcet):
+            f.write(b"KCET" + struct.pack("<I", tsdb_size - 0x08))
+            f.write(b"TSDB" + struct.pack("<II", tsdb_size - 0x14, SDD_KDT_PER_TSDB))
+            for j in range(SDD_KDT_PER_TSDB):
+                f.write(b"KDT2" + struct.pack("<III", 0x08 + SDD_KDT_SIZE, seq_num, 0))
+                f.write(b"KDT1" + struct.pack("<I", 0x08 + SDD_KDT_SIZE))
+                filler.write(f, SDD_KDT_SIZE)
+                seq_num += 1
+        write_pbav(f, filler, align(max(0x100, size - f.tell()), 0x10))
+    return [path]
+
+# Nanobreaker irxpack.bin: ELF modules with their name at 0x8E
+
+IRX_NAMES = ("Sound_Device_Library", "sdr_driver", "cdvd_st_driver", "libsmf2_driver", "sdstr3_driver")
+IRX_MAX_MODULES = 0x200
+
+def gen_irxpack(outdir, size, filler):
+    path = os.path.join(outdir, "irxpack.bin")
+    count = min(IRX_MAX_MODULES, max(len(IRX_NAMES), size // 0x100000))
+    module_size = max(0x1000, size // count)
+    with open(path, "wb") as f:
+        f.write(struct.pack("<I", count))
+        f.write(struct.pack("<%dI" % count, *([module_size] * count)))
+        for i in range(count):
+            write_zeros(f, align(f.tell(), 0x10) - f.tell())
+            if i < len(IRX_NAMES):
+                name = IRX_NAMES[i]
+            else:
+                name = "bench_module_%03d" % i
+            head = bytearray(0x8E)
+            head[0x00:0x04] = b"\x7fELF"
+            head += name.encode("ASCII") + b"\x00"
+            f.write(head)
+            filler.write(f, module_size - len(head))
+    return [path]
+
+# Silent Hill 3 / 4 sd.bin: three sector-aligned sections behind a header
+
+def write_sections(f, filler, sections, sizes):
+    # returns the (sector, size) of each section, in the order given
+    layout = []
+    for section, section_size in zip(sections, sizes):
+        write_zeros(f, align(f.tell(), SECTOR_SIZE) - f.tell())
+        layout.append((f.tell() // SECTOR_SIZE, section_size))
+        f.write(section)
+        filler.write(f, section_size - len(section))
+    write_zeros(f, align(f.tell(), SECTOR_SIZE) - f.tell())
+    finish(f)
+    return layout
+
+def section_sizes(size):
+    return [max(0x100, size // 16), max(0x100, size // 16), max(0x100, size - size // 8)]
+
+def gen_sh3_sd(outdir, size, filler):
+    path = os.path.join(outdir, "sd.bin")
+    with open(path, "wb") as f:
+        f.seek(SECTOR_SIZE)
+        (td, hd, bd) = write_sections(f, filler, (b"SdDt", b"IECS", b""), section_sizes(size))
+        f.seek(0)
+        f.write(b"TYOSD v-1.01\x03\x00\x00\x00")
+        f.write(struct.pack("<6I", td[0], td[1], hd[0], hd[1], bd[0], bd[1]))
+    return [path]
+
+def gen_sh4_sd(outdir, size, filler):
+    path = os.path.join(outdir, "sd.bin")
+    td_size, hd_size, bd_size = section_sizes(size)
+    with open(path, "wb") as f:
+        f.seek(SECTOR_SIZE)
+        (hd, bd, td) = write_sections(f, filler, (b"IECS", b"", b"SdDt"), (hd_size, bd_size, td_size))
+        f.seek(0x10)
+        f.write(struct.pack("<6I", hd[0], hd[1], bd[0], bd[1], td[0], td[1]))
+    return [path]
+
+# Suikoden 4 trg.bin: groups of TD, HD and BD members
+
+TRG_GROUP_SIZE = 0x80000
+
+def gen_trg(outdir, size, filler):
+    path = os.path.join(outdir, "trg.bin")
+    num_groups = max(1, size // TRG_GROUP_SIZE)
+    td_size, hd_size, bd_size = section_sizes(TRG_GROUP_SIZE)
+    table_size = 0x10 + num_groups * 3 * 8
+    with open(path, "wb") as f:
+        f.seek(align(table_size, SECTOR_SIZE))
+        table = []
+        for group in range(num_groups):
+            # odd sizes, so members do not all end on a sector boundary
+            sizes = (td_size - group % 7, hd_size, bd_size - group % 13)
+            table += write_sections(f, filler, (b"SdDt", b"IECS", b""), sizes)
+        f.seek(0x0C)
+        f.write(struct.pack("<I", len(table)))
+        for sector, member_size in table:
+            f.write(struct.pack("<II", sector, member_size))
+    return [path]
+
+# Harvest Moon .arc: pool, proj, sdir and song at offsets from a table at 0x30
+
+def gen_arc(outdir, size, filler):
+    path = os.path.join(outdir, "bench.arc")
+    sizes = (max(0x20, size // 2), max(0x20, size // 8), max(0x20, size // 8), max(0x20, size // 4))
+    with open(path, "wb") as f:
+        f.write(bytes(0x60))
+        table = []
+        for chunk_size in sizes:
+            write_zeros(f, align(f.tell(), 0x20) - f.tell())
+            table.append((f.tell(), chunk_size))
+            filler.write(f, chunk_size)
+        f.seek(0x30)
+        for offset, chunk_size in table:
+            f.write(struct.pack(">III", offset, chunk_size, 0))
+    return [path]
+
+# Skies of Arcadia .info: u16 offset table (in words), last chunk to the end
+
+INFO_NUM_SONGS = 8
+
+def gen_info(outdir, size, filler):
+    path = os.path.join(outdir, "bench.info")
+    # all but the last chunk must start below 0x40000 (u16 word offsets)
+    chunk_size = min(0x4000, max(0x20, size // (4 + INFO_NUM_SONGS)))
+    num_chunks = 3 + INFO_NUM_SONGS
+    table_size = align((num_chunks + 1) * 2, 4)
+    offsets = [table_size + i * chunk_size for i in range(num_chunks)]
+    with open(path, "wb") as f:
+        f.write(struct.pack(">%dH" % num_chunks, *[offset // 4 for offset in offsets]))
+        write_zeros(f, table_size - f.tell())
+        filler.write(f, (num_chunks - 1) * chunk_size)
+        filler.write(f, max(chunk_size, size - f.tell()))
+    return [path]
+
+# Lost Kingdoms .pps: pool, proj and sdir offsets at 0x08
+
+def gen_pps(outdir, size, filler):
+    path = os.path.join(outdir, "bench.pps")
+    pool_size = max(0x20, size // 2)
+    proj_size = max(0x20, size // 4)
+    sdir_size = max(0x20, size - pool_size - proj_size)
+    with open(path, "wb") as f:
+        f.write(struct.pack(">5I", 0, 3, 0x20, 0x20 + pool_size, 0x20 + pool_size + proj_size))
+        write_zeros(f, 0x20 - f.tell())
+        filler.write(f, pool_size + proj_size + sdir_size)
+    return [path]
+
+# Nintendo Puzzle Collection: the disc files at the layout the extractor
+# expects; their size is set by that layout, not by the size asked for
+
+def gen_puzzle_collection(outdir, size, filler):
+    import nintendo_puzzle_collection_musyx as musyx
+    root = os.path.join(outdir, "puzzle_collection")
+    input_sizes = {}
+    for output_dirname in musyx.meta:
+        for input_relpath, entries in musyx.meta[output_dirname].items():
+            end = max([offset + length for offset, length, name in entries if offset != -1] + [0x1000])
+            input_sizes[input_relpath] = max(input_sizes.get(input_relpath, 0), end)
+    for input_relpath, input_size in sorted(input_sizes.items()):
+        path = os.path.join(root, input_relpath.lstrip("\\/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            filler.write(f, input_size)
+    return [root]
+
+generators = {
+    "sdd": gen_sdd,
+    "irxpack": gen_irxpack,
+    "sh3_sd": gen_sh3_sd,
+    "sh4_sd": gen_sh4_sd,
+    "trg": gen_trg,
+    "arc": gen_arc,
+    "info": gen_info,
+    "pps": gen_pps,
+    "puzzle_collection": gen_puzzle_collection,
+}
+
+def generate(outdir, names, size, seed=1):
+    # {format: [input paths]}
+    filler = Filler(seed)
+    inputs = {}
+    for name in names:
+        fmt_dir = os.path.join(outdir, name)
+        os.makedirs(fmt_dir, exist_ok=True)
+        inputs[name] = generators[name](fmt_dir, size, filler)
+    return inputs
+
+def main(argc=len(sys.argv), argv=sys.argv):
+    args = argv[1:argc]
+    size = 16 << 20
+    seed = 1
+
+    while len(args) > 1 and args[0] in ("-s", "-r"):
+        opt = args.pop(0)
+        if opt == "-s":
+            size = parse_size(args.pop(0))
+        else:
+            seed = int(args.pop(0))
+
+    if not args or any(name not in generators for name in args[1:]):
+        print(USAGE % (argv[0], ", ".join(generators)))
+        return 1
+
+    inputs = generate(args[0], args[1:] or list(generators), size, seed)
+
+    for name in inputs:
+        for path in inputs[name]:
+            print("%s: %s" % (name, path))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
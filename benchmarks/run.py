@@ -0,0 +1,251 @@
+# Extractor benchmarks on synthetic inputs
+#
+# Each extractor runs in a fresh interpreter on inputs made by generate.py,
+# and reports wall time, throughput, peak RSS and I/O syscall counts. Results
+# can be appended to a JSON lines file to follow them over time.
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+
+import generate
+
+USAGE = """Usage: %s [-s <size>] [-n <runs>] [-w <work_dir>] [-o <results.jsonl>] [-t] [<format> ...]
+
+  -s  approximate size of each input, with an optional K, M or G suffix
+      (default: 16M)
+  -n  runs per format; the fastest is reported (default: 3)
+  -w  where to generate inputs (default: a temporary directory, removed
+      afterwards); inputs already there are reused
+  -o  append the results as one JSON line to this file
+  -t  also count all syscalls with strace, if it is installed
+
+Formats: %s"""
+
+def read_proc_io():
+    # read/write syscall and byte counters of this process (Linux only)
+    try:
+        with open("/proc/self/io") as f:
+            return dict((key, int(value)) for key, value in (line.split(":") for line in f))
+    except (IOError, OSError, ValueError):
+        return None
+
+def get_peak_rss():
+    # in KiB, including worker processes
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == "darwin":
+        peak //= 1024
+    return peak
+
+def run_extractor(name, path):
+    import extract
+    if name == "puzzle_collection":
+        extract.extract_puzzle_collection(path, os.path.dirname(path))
+    else:
+        dict((fmt.name, fmt) for fmt in extract.formats)[name].extract(path)
+
+def child_main(name, path):
+    # extractor output goes nowhere; only the metrics are printed
+    stdout = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    io_before = read_proc_io()
+    start = time.perf_counter()
+    run_extractor(name, path)
+    elapsed = time.perf_counter() - start
+    io_after = read_proc_io()
+    sys.stdout.flush()
+    os.dup2(stdout, 1)
+    metrics = {"elapsed": elapsed, "peak_rss_kib": get_peak_rss()}
+    if io_before is not None and io_after is not None:
+        for key in ("syscr", "syscw", "rchar", "wchar"):
+            metrics[key] = io_after[key] - io_before[key]
+    print(json.dumps(metrics))
+    return 0
+
+def list_files(dirpath):
+    paths = set()
+    for root, dirnames, filenames in os.walk(dirpath):
+        for filename in filenames:
+            paths.add(os.path.join(root, filename))
+    return paths
+
+def remove_outputs(dirpath, inputs):
+    for path in list_files(dirpath) - inputs:
+        os.remove(path)
+    for root, dirnames, filenames in os.walk(dirpath, topdown=False):
+        for dirname in dirnames:
+            subdir = os.path.join(root, dirname)
+            if not os.listdir(subdir):
+                os.rmdir(subdir)
+
+def parse_strace_total(path):
+    # last line of the strace -c table: "100.00  <secs> ... <calls> <errors> total"
+    with open(path) as f:
+        lines = [line.split() for line in f if line.strip().endswith("total")]
+    if not lines:
+        return None
+    fields = lines[-1]
+    if len(fields) == 6:
+        return int(fields[3])
+    return int(fields[-2])
+
+def run_once(name, path, use_strace):
+    cmd = [sys.executable, os.path.abspath(__file__), "--child", name, path]
+    strace_path = None
+    if use_strace:
+        fd, strace_path = tempfile.mkstemp(suffix=".strace")
+        os.close(fd)
+        cmd = ["strace", "-f", "-c", "-o", strace_path] + cmd
+    try:
+        output = subprocess.check_output(cmd)
+        metrics = json.loads(output.decode("ASCII").strip().splitlines()[-1])
+        if strace_path is not None:
+            metrics["syscalls"] = parse_strace_total(strace_path)
+    finally:
+        if strace_path is not None:
+            os.remove(strace_path)
+    return metrics
+
+def bench_format(name, work_dir, size, runs, use_strace):
+    fmt_dir = os.path.join(work_dir, name)
+    if os.path.isdir(fmt_dir) and os.listdir(fmt_dir):
+        paths = [os.path.join(fmt_dir, entry) for entry in sorted(os.listdir(fmt_dir))]
+    else:
+        paths = generate.generate(work_dir, [name], size)[name]
+
+    inputs = set()
+    input_size = 0
+    for path in paths:
+        found = list_files(path) if os.path.isdir(path) else set([path])
+        inputs |= found
+        input_size += sum(os.path.getsize(p) for p in found)
+
+    best = None
+    for i in range(runs):
+        remove_outputs(fmt_dir, inputs)
+        metrics = {"elapsed": 0.0}
+        for path in paths:
+            for key, value in run_once(name, path, use_strace).items():
+                if value is None:
+                    metrics[key] = None
+                elif key == "peak_rss_kib":
+                    metrics[key] = max(metrics.get(key) or 0, value)
+                else:
+                    metrics[key] = metrics.get(key, 0) + value
+        if best is None or metrics["elapsed"] < best["elapsed"]:
+            best = metrics
+
+    outputs = list_files(fmt_dir) - inputs
+    output_size = sum(os.path.getsize(path) for path in outputs)
+    remove_outputs(fmt_dir, inputs)
+
+    best.update({
+        "format": name,
+        "input_bytes": input_size,
+        "output_bytes": output_size,
+        "outputs": len(outputs),
+        "mib_per_s": output_size / (1 << 20) / best["elapsed"] if best["elapsed"] else None,
+    })
+    return best
+
+def format_value(value, fmt):
+    return "-" if value is None else fmt % value
+
+def print_results(results):
+    print("%-18s %10s %10s %8s %10s %10s %8s %8s %10s" % (
+        "format", "input", "output", "files", "time (s)", "MiB/s", "RSS MiB", "syscr", "syscw"))
+    for r in results:
+        print("%-18s %10s %10s %8d %10s %10s %8s %8s %10s" % (
+            r["format"],
+            "%.1fM" % (r["input_bytes"] / float(1 << 20)),
+            "%.1fM" % (r["output_bytes"] / float(1 << 20)),
+            r["outputs"],
+            "%.3f" % r["elapsed"],
+            format_value(r["mib_per_s"], "%.1f"),
+            format_value(r.get("peak_rss_kib") and r["peak_rss_kib"] / 1024.0, "%.1f"),
+            format_value(r.get("syscr"), "%d"),
+            format_value(r.get("syscw"), "%d")))
+        if "syscalls" in r:
+            print("%-18s %s syscalls in total" % ("", format_value(r["syscalls"], "%d")))
+
+def main(argc=len(sys.argv), argv=sys.argv):
+    args = argv[1:argc]
+
+    if args[:1] == ["--child"] and len(args) == 3:
+        return child_main(args[1], args[2])
+
+    size = 16 << 20
+    runs = 3
+    work_dir = None
+    results_path = None
+    use_strace = False
+
+    while args and args[0] in ("-s", "-n", "-w", "-o", "-t"):
+        opt = args.pop(0)
+        if opt == "-t":
+            use_strace = True
+        elif not args:
+            args = [None]
+        elif opt == "-s":
+            size = generate.parse_size(args.pop(0))
+        elif opt == "-n":
+            runs = max(1, int(args.pop(0)))
+        elif opt == "-w":
+            work_dir = os.path.realpath(args.pop(0))
+        else:
+            results_path = args.pop(0)
+
+    if any(name not in generate.generators for name in args):
+        print(USAGE % (argv[0], ", ".join(generate.generators)))
+        return 1
+
+    if use_strace and shutil.which("strace") is None:
+        print("strace not found, counting read/write syscalls only")
+        use_strace = False
+
+    names = args or list(generate.generators)
+
+    keep = work_dir is not None
+    if not keep:
+        work_dir = tempfile.mkdtemp(prefix="extractors_bench_")
+
+    try:
+        results = []
+        for name in names:
+            results.append(bench_format(name, work_dir, size, runs, use_strace))
+    finally:
+        if not keep:
+            shutil.rmtree(work_dir)
+
+    print_results(results)
+
+    if results_path is not None:
+        with open(results_path, "a") as f:
+            f.write(json.dumps({
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "size": size,
+                "runs": runs,
+                "results": results,
+            }, sort_keys=True) + "\n")
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,55 @@
+# Binary reading helpers shared by the extractors
+#
+# All readers work on bytes, bytearray, mmap and memoryview objects alike and
+# use precompiled structs with unpack_from, so no slice is made per field.
+
+import struct
+
+u16_le = struct.Struct("<H")
+u32_le = struct.Struct("<I")
+u16_be = struct.Struct(">H")
+u32_be = struct.Struct(">I")
+s16_be = struct.Struct(">h")
+
+def get_u16_le(buf, off=0):
+    return u16_le.unpack_from(buf, off)[0]
+
+def get_u32_le(buf, off=0):
+    return u32_le.unpack_from(buf, off)[0]
+
+def get_u16_be(buf, off=0):
+    return u16_be.unpack_from(buf, off)[0]
+
+def get_u32_be(buf, off=0):
+    return u32_be.unpack_from(buf, off)[0]
+
+def get_s16_be(buf, off=0):
+    return s16_be.unpack_from(buf, off)[0]
+
+def read_u32_le(f):
+    return u32_le.unpack(f.read(4))[0]
+
+def read_u32_be(f):
+    return u32_be.unpack(f.read(4))[0]
+
+def write_u32_le(f, x):
+    f.write(u32_le.pack(x))
+
+def read_struct(f, record):
+    return record.unpack(f.read(record.size))
+
+def iter_records(record, buf, count, off=0):
+    # decode a table of count fixed-size records in one go
+    end = off + count * record.size
+    if end > len(buf):
+        raise ValueError("Table of %d records at 0x%X runs past the end of the data" % (count, off))
+    return record.iter_unpack(memoryview(buf)[off:end])
+
+def get_u32_table_le(buf, count, off=0):
+    return [value for (value,) in iter_records(u32_le, buf, count, off)]
+
+def get_u32_table_be(buf, count, off=0):
+    return [value for (value,) in iter_records(u32_be, buf, count, off)]
+
+def get_u16_table_be(buf, count, off=0):
+    return [value for (value,) in iter_records(u16_be, buf, count, off)]
@@ -0,0 +1,263 @@
+# Read-only access to the members of a container without extracting them
+#
+# A member is made of segments, each either a byte range of a source file or
+# a bytes object (for data the extractors synthesize, like the pBAV program
+# table). Members are read with positioned reads straight from the source,
+# which never move a shared file offset, so any number of threads can read
+# members of the same container at once without locking.
+
+import io
+import os
+import bisect
+import threading
+import collections
+import concurrent.futures
+
+import metrics
+
+Member = collections.namedtuple("Member", "name size segments")
+
+DEFAULT_WORKERS = 8
+
+# how much of the members read_many hands out may be read ahead
+MAX_READ_AHEAD = 64 * 1024 * 1024
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+OUTPUT_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+
+_seek_lock = threading.Lock()
+
+def pread(fd, size, offset):
+    if hasattr(os, "pread"):
+        data = os.pread(fd, size, offset)
+    else:
+        with _seek_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            data = os.read(fd, size)
+        metrics.count("seeks")
+    metrics.count_read(len(data))
+    return data
+
+def write_all(fd, data):
+    view = memoryview(data).cast("B")
+    while view:
+        n = os.write(fd, view)
+        metrics.count_write(n)
+        view = view[n:]
+
+def count_copy(n):
+    # in-kernel copies are counted as both a read and a write
+    metrics.count_read(n)
+    metrics.count_write(n)
+
+def copy_segment(fd, offset, size, out):
+    # out is a file descriptor, or a file-like object without one (an archive
+    # member); the source offset is passed in every call, so the copy is
+    # positioned like pread; the output offset is the output's own
+    done = 0
+    out_fd = out if isinstance(out, int) else None
+
+    if out_fd is not None and hasattr(os, "copy_file_range"):
+        try:
+            while done < size:
+                copied = os.copy_file_range(fd, out_fd, size - done, offset + done)
+                if copied == 0:
+                    break
+                count_copy(copied)
+                done += copied
+        except OSError:
+            pass
+
+    if out_fd is not None and done < size and hasattr(os, "sendfile"):
+        try:
+            while done < size:
+                copied = os.sendfile(out_fd, fd, offset + done, size - done)
+                if copied == 0:
+                    break
+                count_copy(copied)
+                done += copied
+        except OSError:
+            pass
+
+    while done < size:
+        buf = pread(fd, min(COPY_CHUNK_SIZE, size - done), offset + done)
+        if not buf:
+            break
+        if out_fd is not None:
+            write_all(out_fd, buf)
+        else:
+            out.write(buf)
+        done += len(buf)
+
+    return done
+
+class MemberReader(io.RawIOBase):
+    def __init__(self, member):
+        self.name = member.name
+        self.size = member.size
+        self.segments = member.segments
+        self.starts = []
+        start = 0
+        for segment in self.segments:
+            self.starts.append(start)
+            start += len(segment) if isinstance(segment, bytes) else segment[2]
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            pos = offset
+        elif whence == os.SEEK_CUR:
+            pos = self.pos + offset
+        elif whence == os.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError("invalid whence (%r)" % whence)
+        if pos < 0:
+            raise ValueError("negative seek position %d" % pos)
+        self.pos = pos
+        return pos
+
+    def readinto(self, b):
+        view = memoryview(b).cast("B")
+        done = 0
+        while done < len(view) and self.pos < self.size:
+            i = bisect.bisect_right(self.starts, self.pos) - 1
+            segment = self.segments[i]
+            delta = self.pos - self.starts[i]
+            if isinstance(segment, bytes):
+                data = segment[delta:delta+len(view)-done]
+            else:
+                fd, offset, size = segment
+                data = pread(fd, min(size - delta, len(view) - done), offset + delta)
+            if not data:
+                # the source file is shorter than its table says
+                break
+            view[done:done+len(data)] = data
+            done += len(data)
+            self.pos += len(data)
+        return done
+
+    def readall(self):
+        buf = bytearray(max(0, self.size - self.pos))
+        del buf[self.readinto(buf):]
+        return bytes(buf)
+
+class Container:
+    def __init__(self):
+        self.fds = []
+        self.members = collections.OrderedDict()
+
+    def add_source(self, path):
+        fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        metrics.count("opens")
+        self.fds.append(fd)
+        return fd
+
+    def add_member(self, name, segments):
+        size = sum(len(segment) if isinstance(segment, bytes) else segment[2] for segment in segments)
+        # same name twice: the later one wins, as it would on disk
+        self.members[name] = Member(name, size, segments)
+
+    def add_range(self, name, fd, offset, size):
+        self.add_member(name, [(fd, offset, size)])
+
+    def names(self):
+        return list(self.members)
+
+    def __iter__(self):
+        return iter(self.members.values())
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, name):
+        return name in self.members
+
+    def open(self, name, buffering=io.DEFAULT_BUFFER_SIZE):
+        reader = MemberReader(self.members[name])
+        if buffering == 0:
+            return reader
+        return io.BufferedReader(reader, buffering)
+
+    def read(self, name):
+        # one buffer for the whole member instead of a read per block
+        member = self.members[name]
+        buf = bytearray(member.size)
+        with MemberReader(member) as f:
+            del buf[f.readinto(buf):]
+        return buf
+
+    def read_many(self, names, workers=DEFAULT_WORKERS, max_read_ahead=MAX_READ_AHEAD):
+        # the data of each member, in order; up to two per worker, and up to
+        # max_read_ahead bytes, are read ahead of the one handed out (a
+        # single member larger than that is read on its own)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = collections.deque()
+            read_ahead = 0
+            for name in names:
+                size = self.members[name].size
+                while pending and (len(pending) >= 2 * workers or read_ahead + size > max_read_ahead):
+                    future, future_size = pending.popleft()
+                    read_ahead -= future_size
+                    yield future.result()
+                pending.append((pool.submit(self.read, name), size))
+                read_ahead += size
+            while pending:
+                yield pending.popleft()[0].result()
+
+    def extract_member(self, name, outdir):
+        member = self.members[name]
+        path = os.path.join(outdir, name)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        with metrics.member(path, member.size):
+            out_fd = os.open(path, OUTPUT_FLAGS, 0o666)
+            metrics.count("opens")
+            try:
+                for segment in member.segments:
+                    if isinstance(segment, bytes):
+                        write_all(out_fd, segment)
+                    else:
+                        copy_segment(segment[0], segment[1], segment[2], out_fd)
+            finally:
+                os.close(out_fd)
+        return path
+
+    def extract(self, outdir, names=None, workers=DEFAULT_WORKERS, output=None):
+        # writes members under their names in outdir, several at a time;
+        # returns the output paths in the order of names
+        if names is None:
+            names = self.names()
+        if output is not None:
+            # members are still read in parallel, but handed over in order
+            paths = [os.path.join(outdir, name) for name in names]
+            for path, data in zip(paths, self.read_many(names, workers)):
+                with metrics.member(path, len(data)):
+                    output.submit(path, data)
+            return paths
+        if workers <= 1:
+            return [self.extract_member(name, outdir) for name in names]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(lambda name: self.extract_member(name, outdir), names))
+
+    def close(self):
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,128 +1,158 @@
 import os
 import sys
-import struct
+import re
+import glob
+import mmap
+import time
+import array
+import collections
+import concurrent.futures
 
-def get_u32_le(buf, off=0):
-  return struct.unpack("<I", buf[off:off+4])[0]
-
-def get_u16_le(buf, off=0):
-  return struct.unpack("<H", buf[off:off+2])[0]
+from binary_reader import get_u16_le, get_u32_le
+from container import Container
+import metrics
 
 class SDD:
-  def __init__(self, filename):
-    with open(filename, "rb") as f:
-      self.name = f.name
-      self.buffer = f.read()
-      self.size = len(self.buffer)
-      self.offset = 0
-      self.seq_num = 0
-      self.num_kdt_extracted = 0
-      self.num_vab_extracted = 0
-
-def calc_num_tones_in_program(tone_table, program_index):
-  num_tones = 0
-  offset = program_index * 0x200
-  for i in range(16):
-    sample_num = get_u16_le(tone_table, offset+0x16)
-    if sample_num != 0:
-      num_tones += 1
-    offset += 0x20
-  return num_tones
-
-def calc_avg_volume_of_instrument(instrument, num_tones):
-  volume_sum = 0
-  offset = 0
-  for i in range(num_tones):
-    volume_sum += instrument[offset+0x02]
-    offset += 0x10
-  return volume_sum // num_tones
+  def __init__(self, filename, mapped=True):
+    self.name = filename
+    self.map = None
+    self.offset = 0
+    self.seq_num = 0
+    self.num_kdt_extracted = 0
+    self.num_vab_extracted = 0
+    # archive.ArchiveOutput to write into instead of files next to the SDD
+    self.output = None
+    with metrics.open_file(filename, "rb") as f:
+      if mapped and os.fstat(f.fileno()).st_size > 0:
+        # views into the mapped file; nothing is copied until written out
+        self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buffer = memoryview(self.map)
+      else:
+        self.buffer = memoryview(f.read())
+    self.size = len(self.buffer)
 
-def calc_avg_pan_of_instrument(instrument, num_tones):
-  pan_sum = 0
-  offset = 0
-  for i in range(num_tones):
-    pan_sum += instrument[offset+0x03]
-    offset += 0x10
-  return pan_sum // num_tones
+  def close(self):
+    self.buffer.release()
+    if self.map is not None:
+      self.map.close()
+      self.map = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, *exc):
+    try:
+      self.close()
+    except BufferError:
+      # the traceback of an error on its way out can still hold views of the
+      # mapping; that error is the one to report, the mapping goes with it
+      if exc_type is None:
+        raise
+
+# program attributes not derived from the tones: prio, mode, and the rest
+# of the 16-byte entry (all programs use the same defaults)
+program_template = bytes(
+  [
+    0, 0, 0, 0, 0,
+    0xFF, 0x00,0x00, 0xFF,0xFF,0xFF,0xFF, 0xFF,0xFF,0xFF,0xFF
+  ]
+)
 
 def generate_program_table(tone_table, num_programs):
-  program_table = bytearray()
+  num_programs = min(num_programs, 128)
+  tone_data = bytes(tone_table[:num_programs*0x200])
+
+  # sample number (u16 at 0x16) of every 0x20-byte tone, 16 tones per program
+  sample_nums = array.array("H", tone_data)
+  if sys.byteorder != "little":
+    sample_nums.byteswap()
+  sample_nums = sample_nums[0x16//2::0x20//2]
+
+  # vol/pan are averaged over 0x10-byte strides of the instrument, which is
+  # how the converter has always done it
+  volumes = tone_data[0x02::0x10]
+  pans = tone_data[0x03::0x10]
 
-  for program_index in range(128):
-    vol, pan, num_tones, mode, prio = (0, 0, 0, 0, 0)
+  tone_counts = bytearray(128)
+  avg_volumes = bytearray(128)
+  avg_pans = bytearray(128)
 
-    if program_index < num_programs:
-      num_tones = calc_num_tones_in_program(tone_table, program_index)
-      instrument_ofs = program_index * 0x200
-      instrument = tone_table[instrument_ofs:instrument_ofs+0x200]
-      vol = calc_avg_volume_of_instrument(instrument, num_tones)
-      pan = calc_avg_pan_of_instrument(instrument, num_tones)
+  for program_index in range(num_programs):
+    num_tones = 16 - sample_nums[program_index*16:program_index*16+16].count(0)
+    start = program_index * 0x20
+    tone_counts[program_index] = num_tones
+    avg_volumes[program_index] = sum(volumes[start:start+num_tones]) // num_tones
+    avg_pans[program_index] = sum(pans[start:start+num_tones]) // num_tones
 
-    program_table += bytearray(
-      [
-        num_tones, vol, prio, mode, pan,
-        0xFF, 0x00,0x00, 0xFF,0xFF,0xFF,0xFF, 0xFF,0xFF,0xFF,0xFF
-      ]
-    )
+  program_table = bytearray(program_template * 128)
+  program_table[0x00::0x10] = tone_counts
+  program_table[0x01::0x10] = avg_volumes
+  program_table[0x04::0x10] = avg_pans
 
   return program_table
 
-def parse_pbav(sdd):
-  size = get_u32_le(sdd.buffer, sdd.offset+0x0C)
-  payload_offset = sdd.offset + 0x00
-  with open("%s.VAB" % (os.path.realpath(sdd.name)), "wb") as vab:
-    if sdd.buffer[sdd.offset:sdd.offset+4] == b"pBAV":
+def open_output(sdd, outpath, size):
+  if sdd.output is None:
+    return metrics.open_file(outpath, "wb")
+  return sdd.output.open(outpath, size)
+
+def extract_vab(sdd, chunk):
+  offset = chunk.offset
+  size = chunk.size
+  outpath = "%s.VAB" % os.path.realpath(sdd.name)
+  # PBAV gains a program table of 128 0x10-byte programs
+  outsize = size if chunk.type == "pBAV" else size + 128 * 0x10
+  with metrics.member(outpath, size), open_output(sdd, outpath, outsize) as vab:
+    if chunk.type == "pBAV":
       # write standard VAB data as-is
-      vab.write(sdd.buffer[sdd.offset:sdd.offset+size])
+      vab.write(sdd.buffer[offset:offset+size])
     else:
       # manually write header magic (PBAV -> pBAV)
       vab.write(b"pBAV")
       # write the rest of the main header
-      vab.write(sdd.buffer[sdd.offset+0x04:sdd.offset+0x20])
+      vab.write(sdd.buffer[offset+0x04:offset+0x20])
       # write program table
-      num_programs = get_u16_le(sdd.buffer, sdd.offset+0x12)
-      tone_table = sdd.buffer[sdd.offset+0x20:sdd.offset+0x20+num_programs*0x200]
+      num_programs = get_u16_le(sdd.buffer, offset+0x12)
+      tone_table = sdd.buffer[offset+0x20:offset+0x20+num_programs*0x200]
       program_table = generate_program_table(tone_table, num_programs)
       vab.write(program_table)
       # write the rest of the VAB data
-      vab.write(sdd.buffer[sdd.offset+0x20:sdd.offset+size])
+      vab.write(sdd.buffer[offset+0x20:offset+size])
   sdd.num_vab_extracted += 1
-  sdd.offset = payload_offset
-  return payload_offset + size
-
-def parse_kdt1(sdd):
-  size = get_u32_le(sdd.buffer, sdd.offset+0x04)
-  payload_offset = sdd.offset + 0x00
-  with open("%s_%d.KDT" % (os.path.realpath(sdd.name), sdd.seq_num), "wb") as kdt:
-    kdt.write(sdd.buffer[sdd.offset:sdd.offset+size])
+
+def extract_kdt(sdd, chunk):
+  outpath = "%s_%d.KDT" % (os.path.realpath(sdd.name), chunk.seq_num)
+  with metrics.member(outpath, chunk.size), open_output(sdd, outpath, chunk.size) as kdt:
+    kdt.write(sdd.buffer[chunk.offset:chunk.offset+chunk.size])
   sdd.num_kdt_extracted += 1
-  sdd.offset = payload_offset
-  return payload_offset + size
-
-def parse_kdt2(sdd):
-  size = get_u32_le(sdd.buffer, sdd.offset+0x04)
-  sdd.seq_num = get_u32_le(sdd.buffer, sdd.offset+0x08)
-  unk0C = get_u32_le(sdd.buffer, sdd.offset+0x0C)
-  payload_offset = sdd.offset + 0x10
-  sdd.offset = payload_offset
-  parse_next(sdd)
-  return payload_offset + size
-
-def parse_tsdb(sdd):
-  size = get_u32_le(sdd.buffer, sdd.offset+0x04)
-  num_kdt_chunks = get_u32_le(sdd.buffer, sdd.offset+0x08)
-  payload_offset = sdd.offset + 0x0C
-  sdd.offset = payload_offset
-  for kdt_num in range(num_kdt_chunks):
-    parse_next(sdd)
-  return payload_offset + size
-
-def parse_kcet(sdd):
-  size = get_u32_le(sdd.buffer, sdd.offset+0x04)
-  payload_offset = sdd.offset + 0x08
-  sdd.offset = payload_offset
-  parse_next(sdd)
-  return payload_offset + size
+
+# chunk header parsers return (payload_offset, end_offset, num_children)
+
+def parse_pbav(sdd, offset):
+  size = get_u32_le(sdd.buffer, offset+0x0C)
+  return offset, offset + size, 0
+
+def parse_kdt1(sdd, offset):
+  size = get_u32_le(sdd.buffer, offset+0x04)
+  return offset, offset + size, 0
+
+def parse_kdt2(sdd, offset):
+  size = get_u32_le(sdd.buffer, offset+0x04)
+  sdd.seq_num = get_u32_le(sdd.buffer, offset+0x08)
+  unk0C = get_u32_le(sdd.buffer, offset+0x0C)
+  payload_offset = offset + 0x10
+  return payload_offset, payload_offset + size, 1
+
+def parse_tsdb(sdd, offset):
+  size = get_u32_le(sdd.buffer, offset+0x04)
+  num_kdt_chunks = get_u32_le(sdd.buffer, offset+0x08)
+  payload_offset = offset + 0x0C
+  return payload_offset, payload_offset + size, num_kdt_chunks
+
+def parse_kcet(sdd, offset):
+  size = get_u32_le(sdd.buffer, offset+0x04)
+  payload_offset = offset + 0x08
+  return payload_offset, payload_offset + size, 1
 
 parsers = {
   b"KCET": parse_kcet,
@@ -133,33 +163,190 @@ parsers = {
   b"pBAV": parse_pbav,
 }
 
+extractors = {
+  "KDT1": extract_kdt,
+  "PBAV": extract_vab,
+  "pBAV": extract_vab,
+}
+
+Chunk = collections.namedtuple("Chunk", "type offset size seq_num path")
+
+# lookahead so that overlapping magics (e.g. "KCETSDB") are all reported
+magic_pattern = re.compile(b"(?=(" + b"|".join(re.escape(m) for m in parsers) + b"))")
+
+def find_next_chunk(sdd, offset, end):
+  # chunk magics are only recognized every 4 bytes from wherever scanning
+  # resumes; only the bytes up to the next one (within end) are looked at
+  pos = offset
+  while True:
+    match = magic_pattern.search(sdd.buffer, pos, end)
+    if match is None:
+      return None
+    if (match.start() - offset) & 3 == 0:
+      return match.start()
+    pos = match.start() + 1
+
+def walk_sdd(sdd):
+  # each stack entry is [type, end_offset, num_children_left] of an open
+  # container; a child is searched for from wherever the previous one ended
+  # up to the end of its container
+  stack = []
+  offset = 0
+  while True:
+    if stack and stack[-1][2] == 0:
+      offset = stack.pop()[1]
+      continue
+    end = min(stack[-1][1], sdd.size) if stack else sdd.size
+    chunk_offset = find_next_chunk(sdd, offset, end)
+    if chunk_offset is None:
+      if not stack:
+        return
+      # no more chunks inside this container, resume after it
+      offset = stack.pop()[1]
+      continue
+    if stack:
+      stack[-1][2] -= 1
+    magic = sdd.buffer[chunk_offset:chunk_offset+4].tobytes()
+    payload_offset, end_offset, num_children = parsers[magic](sdd, chunk_offset)
+    sdd.offset = chunk_offset
+    chunk_type = magic.decode("ASCII")
+    yield Chunk(chunk_type, chunk_offset, end_offset - chunk_offset, sdd.seq_num, tuple(frame[0] for frame in stack))
+    if num_children:
+      stack.append([chunk_type, end_offset, num_children])
+      offset = payload_offset
+    else:
+      offset = end_offset
+
+def vab_segments(sdd, chunk, fd):
+  offset = chunk.offset
+  size = chunk.size
+  if chunk.type == "pBAV":
+    return [(fd, offset, size)]
+  num_programs = get_u16_le(sdd.buffer, offset+0x12)
+  tone_table = sdd.buffer[offset+0x20:offset+0x20+num_programs*0x200]
+  program_table = bytes(generate_program_table(tone_table, num_programs))
+  del tone_table
+  return [b"pBAV", (fd, offset+0x04, 0x1C), program_table, (fd, offset+0x20, size-0x20)]
+
+def open_container(path):
+  container = Container()
+  try:
+    fd = container.add_source(path)
+    name = os.path.basename(path)
+    with SDD(path) as sdd:
+      for chunk in walk_sdd(sdd):
+        if chunk.type == "KDT1":
+          container.add_range("%s_%d.KDT" % (name, chunk.seq_num), fd, chunk.offset, chunk.size)
+        elif chunk.type in ("PBAV", "pBAV"):
+          container.add_member("%s.VAB" % name, vab_segments(sdd, chunk, fd))
+  except:
+    container.close()
+    raise
+  return container
+
 def parse_sdd(sdd):
-  while parse_next(sdd):
-    continue
-
-def parse_next(sdd):
-  while sdd.offset + 4 <= len(sdd.buffer):
-    magic = sdd.buffer[sdd.offset:sdd.offset+4]
-    if magic in parsers:
-      end_offset = parsers[magic](sdd)
-      sdd.offset = end_offset
-      return True
+  for chunk in walk_sdd(sdd):
+    if chunk.type in extractors:
+      extractors[chunk.type](sdd, chunk)
+
+def list_sdd(sdd):
+  for chunk in walk_sdd(sdd):
+    print("%08X %08X %-4s %4d  %s" % (chunk.offset, chunk.size, chunk.type, chunk.seq_num, "/".join(chunk.path + (chunk.type,))))
+
+ExtractResult = collections.namedtuple("ExtractResult", "name size num_kdt num_vab seconds")
+
+def extract_sdd(path, output=None):
+  start = time.perf_counter()
+  with SDD(path) as sdd:
+    sdd.output = output
+    parse_sdd(sdd)
+  elapsed = time.perf_counter() - start
+  return ExtractResult(sdd.name, sdd.size, sdd.num_kdt_extracted, sdd.num_vab_extracted, elapsed)
+
+def collect_sdd_paths(args):
+  paths = []
+  for arg in args:
+    if os.path.isdir(arg):
+      for filename in sorted(os.listdir(arg)):
+        path = os.path.join(arg, filename)
+        if os.path.splitext(filename)[1].lower() == ".sdd" and os.path.isfile(path):
+          paths.append(path)
+    elif os.path.isfile(arg):
+      paths.append(arg)
     else:
-      sdd.offset += 4
-  return False
+      matches = sorted(glob.glob(arg))
+      if not matches:
+        print("ERROR: Invalid file path: %s" % arg)
+      paths.extend(path for path in matches if os.path.isfile(path))
+  # the same file listed twice would race on its own outputs
+  unique = []
+  seen = set()
+  for path in paths:
+    real = os.path.realpath(path)
+    if real not in seen:
+      seen.add(real)
+      unique.append(path)
+  return unique
+
+def extract_batch(paths, workers=None):
+  if workers is None:
+    workers = os.cpu_count() or 1
+  workers = max(1, min(workers, len(paths)))
+  if workers == 1:
+    return [extract_sdd(path) for path in paths]
+  # each SDD writes only to its own outputs, so files can run in any order;
+  # map() hands the results back in input order
+  with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+    return list(pool.map(extract_sdd, paths))
+
+def print_summary(result):
+  print("Extraction summary for: %s" % result.name)
+  print("  KDT: %d" % result.num_kdt)
+  print("  VAB: %d" % result.num_vab)
+  print("  Time: %.3fs" % result.seconds)
 
 def main(argc=len(sys.argv), argv=sys.argv):
-  if argc < 2:
-    print("Usage: %s <SDD>" % argv[0])
+  usage = "Usage: %s [-l] [-j <workers>] <SDD|dir|glob> [...]" % argv[0]
+
+  args = argv[1:argc]
+  list_only = False
+  workers = None
+
+  while args and args[0] in ("-l", "-j"):
+    opt = args.pop(0)
+    if opt == "-l":
+      list_only = True
+    elif args and args[0].isdigit() and int(args[0]) > 0:
+      workers = int(args.pop(0))
+    else:
+      print(usage)
+      return 1
+
+  paths = collect_sdd_paths(args)
+
+  if not paths:
+    print(usage)
     return 1
 
-  sdd = SDD(argv[1])
+  if list_only:
+    for path in paths:
+      with SDD(path) as sdd:
+        list_sdd(sdd)
+    return 0
+
+  start = time.perf_counter()
+  results = extract_batch(paths, workers)
+  elapsed = time.perf_counter() - start
 
-  parse_sdd(sdd)
+  for result in results:
+    print_summary(result)
 
-  print("Extraction summary for: %s" % sdd.name)
-  print("  KDT: %d" % sdd.num_kdt_extracted)
-  print("  VAB: %d" % sdd.num_vab_extracted)
+  if len(results) > 1:
+    total_size = sum(result.size for result in results)
+    print("Combined summary for %d files:" % len(results))
+    print("  KDT: %d" % sum(result.num_kdt for result in results))
+    print("  VAB: %d" % sum(result.num_vab for result in results))
+    print("  Time: %.3fs (%.2f MB/s)" % (elapsed, total_size / 1048576 / elapsed if elapsed else 0.0))
 
   return 0
 
@@ -0,0 +1,325 @@
+# Runs the matching extractor for each given file
+#
+# The format is detected from the file header (and extension where the format
+# has no magic of its own), and only the extractor module for that format is
+# imported.
+
+import os
+import sys
+import struct
+import collections
+
+from binary_reader import get_u16_be, get_u32_be, get_u32_le
+import metrics
+
+USAGE = """Usage: %s [-n] [-o <output_dir>] [-a <archive>] [-m <metrics.json>] [-p <profile.out>] <file|dir> [<file|dir> ...]
+
+  -n  only print the detected format of each file
+  -o  where to put the musyx_data folder of a Nintendo Puzzle Collection
+      disc (default: the disc directory itself)
+  -a  write everything into one .tar, .tar.gz, .tar.xz or .zip archive
+      instead, under paths relative to the deepest directory shared by all
+      outputs
+  -m  write per-file timings, I/O counts and member latencies as JSON
+  -p  write a cProfile dump of the whole run (see the pstats module)
+
+Directories are searched recursively. A directory holding the files of the
+Nintendo Puzzle Collection disc is extracted as a whole.
+
+Detected formats:
+%s"""
+
+HEADER_SIZE = 0x40
+
+SECTOR_SIZE = 2048
+
+# files that only the Puzzle Collection disc is expected to have
+PUZZLE_COLLECTION_FILES = ("PANEPON.plf", "panepon.rel", "Dr_MARIO.plf", "menu_relsamp.bin")
+
+def get_ext(path):
+    return os.path.splitext(path)[1].lower()
+
+def is_sh3_sd(path, f, head, size):
+    return head[:0x10] == b"TYOSD v-1.01\x03\x00\x00\x00"
+
+def is_hd(path, f, head, size):
+    # a version chunk, then the header chunk
+    if head[:8] != b"IECSsreV":
+        return False
+    f.seek(get_u32_le(head, 0x08))
+    return f.read(8) == b"IECSdaeH"
+
+def is_sdd(path, f, head, size):
+    return head[:4] in (b"KCET", b"TSDB") or get_ext(path) == ".sdd"
+
+def is_pps(path, f, head, size):
+    if get_ext(path) != ".pps" or len(head) < 0x14 or get_u32_be(head, 0x04) != 3:
+        return False
+    pool_off, proj_off, sdir_off = struct.unpack_from(">3I", head, 0x08)
+    return pool_off <= proj_off <= sdir_off <= size
+
+def is_arc(path, f, head, size):
+    if get_ext(path) != ".arc" or len(head) < 0x40:
+        return False
+    f.seek(0x30)
+    table = f.read(0x30)
+    if len(table) != 0x30:
+        return False
+    for offset, length, unused in struct.iter_unpack(">III", table):
+        if offset + length > size:
+            return False
+    return True
+
+def is_info(path, f, head, size):
+    if get_ext(path) != ".info" or len(head) < 2:
+        return False
+    return 0 < 4 * get_u16_be(head, 0x00) <= size
+
+def is_irxpack(path, f, head, size):
+    if len(head) < 4:
+        return False
+    count = get_u32_le(head, 0x00)
+    if not 0 < count < 0x400 or 4 + count * 4 > size:
+        return False
+    f.seek(4)
+    sizes = struct.unpack("<%dI" % count, f.read(count * 4))
+    offset = 4 + count * 4
+    for module_size in sizes:
+        offset = ((offset - 1) & ~0xF) + 0x10 + module_size
+    if offset > size:
+        return False
+    # IRX modules are ELF files
+    f.seek(((4 + count * 4 - 1) & ~0xF) + 0x10)
+    return f.read(4) == b"\x7fELF"
+
+def is_trg(path, f, head, size):
+    if len(head) < 0x10:
+        return False
+    num_files = get_u32_le(head, 0x0C)
+    if num_files == 0 or num_files % 3 or 0x10 + num_files * 8 > size:
+        return False
+    f.seek(0x10)
+    table = f.read(num_files * 8)
+    entries = list(struct.iter_unpack("<II", table))
+    if any(sect * SECTOR_SIZE + length > size for sect, length in entries):
+        return False
+    f.seek(entries[0][0] * SECTOR_SIZE)
+    return f.read(4) in (b"SdDt", b"IECS")
+
+def is_sh4_sd(path, f, head, size):
+    if len(head) < 0x28:
+        return False
+    sections = sorted(zip(*[iter(struct.unpack_from("<6I", head, 0x10))] * 2))
+    end = SECTOR_SIZE
+    for sect, length in sections:
+        if sect * SECTOR_SIZE < end:
+            return False
+        end = sect * SECTOR_SIZE + length
+    return end <= size
+
+# output is an archive.ArchiveOutput, or None to write files next to the input
+
+def extract_sh3_sd(path, output=None):
+    import silent_hill_3_sd
+    silent_hill_3_sd.extract_sd(path, output=output)
+
+def extract_hd(path, output=None):
+    import ps2_hd_bd
+    if not os.path.isfile(ps2_hd_bd.get_bd_path(path)):
+        print("ERROR: No BD next to %s" % path)
+        return
+    ps2_hd_bd.extract_bank(path, output=output)
+
+def extract_sdd(path, output=None):
+    import elder_gate_sdd
+    elder_gate_sdd.print_summary(elder_gate_sdd.extract_sdd(path, output))
+
+def extract_pps(path, output=None):
+    import lost_kingdoms_pps
+    lost_kingdoms_pps.extract(path, output)
+
+def extract_arc(path, output=None):
+    import harvest_moon_arc
+    harvest_moon_arc.extract_arc(path, output)
+
+def extract_info(path, output=None):
+    import skies_of_arcadia_info
+    skies_of_arcadia_info.extract_info(path, output)
+
+def extract_irxpack(path, output=None):
+    import nanobreaker_irxpack
+    nanobreaker_irxpack.extract_irxpack(path, output=output)
+
+def extract_trg(path, output=None):
+    import suikoden4_trg
+    suikoden4_trg.extract_trg(path, output=output)
+
+def extract_sh4_sd(path, output=None):
+    import silent_hill_4_sd
+    silent_hill_4_sd.extract_sd(path, output=output)
+
+# in detection order: formats with a magic first, weak structural checks last
+Format = collections.namedtuple("Format", "name description detect extract")
+
+formats = [
+    Format("sh3_sd", "Silent Hill 3 sd.bin", is_sh3_sd, extract_sh3_sd),
+    Format("hd", "PS2 sound bank .HD (with its .BD)", is_hd, extract_hd),
+    Format("sdd", "Elder Gate SDD", is_sdd, extract_sdd),
+    Format("pps", "Lost Kingdoms .pps", is_pps, extract_pps),
+    Format("arc", "Harvest Moon sound .arc", is_arc, extract_arc),
+    Format("info", "Skies of Arcadia .info", is_info, extract_info),
+    Format("irxpack", "Nanobreaker irxpack.bin", is_irxpack, extract_irxpack),
+    Format("trg", "Suikoden 4 trg.bin", is_trg, extract_trg),
+    Format("sh4_sd", "Silent Hill 4 sd.bin", is_sh4_sd, extract_sh4_sd),
+]
+
+def detect_format(path):
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        head = f.read(HEADER_SIZE)
+        for fmt in formats:
+            try:
+                if fmt.detect(path, f, head, size):
+                    return fmt
+            except (struct.error, IndexError, OverflowError):
+                pass
+    return None
+
+def is_puzzle_collection_dir(path):
+    return all(os.path.isfile(os.path.join(path, name)) for name in PUZZLE_COLLECTION_FILES)
+
+def extract_puzzle_collection(path, output_dir=None, output=None):
+    import nintendo_puzzle_collection_musyx
+    if not nintendo_puzzle_collection_musyx.verify_game_dir(path):
+        print("ERROR: Incomplete Nintendo Puzzle Collection disc: %s" % path)
+        return
+    root_output_dir = os.path.join(output_dir or path, "musyx_data")
+    if output is None and not os.path.isdir(root_output_dir):
+        os.makedirs(root_output_dir)
+    nintendo_puzzle_collection_musyx.extract_game(path, root_output_dir, output=output)
+
+def get_archive_root(jobs, output_dir=None):
+    # every extractor writes next to its input, except the Puzzle Collection
+    dirs = []
+    for path, fmt in jobs:
+        if fmt == "puzzle_collection":
+            dirs.append(output_dir or path)
+        elif fmt is not None:
+            dirs.append(os.path.dirname(path))
+    return os.path.commonpath(dirs) if dirs else os.getcwd()
+
+def collect_jobs(args):
+    # (path, format) pairs; format is None for unrecognized files
+    jobs = []
+    for arg in args:
+        path = os.path.realpath(arg)
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                if is_puzzle_collection_dir(dirpath):
+                    # the disc is extracted as a whole, none of its files alone
+                    jobs.append((dirpath, "puzzle_collection"))
+                    dirnames[:] = []
+                    continue
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    filepath = os.path.join(dirpath, filename)
+                    fmt = detect_format(filepath)
+                    if fmt is not None:
+                        jobs.append((filepath, fmt))
+        elif os.path.isfile(path):
+            jobs.append((path, detect_format(path)))
+        else:
+            print("ERROR: Invalid file path: %s" % arg)
+    return jobs
+
+def main(argc=len(sys.argv), argv=sys.argv):
+    args = argv[1:argc]
+    detect_only = False
+    output_dir = None
+    archive_path = None
+    metrics_path = None
+    profile_path = None
+
+    while args and args[0] in ("-n", "-o", "-a", "-m", "-p"):
+        opt = args.pop(0)
+        if opt == "-n":
+            detect_only = True
+        elif not args:
+            pass
+        elif opt == "-o":
+            output_dir = os.path.realpath(args.pop(0))
+        elif opt == "-a":
+            archive_path = args.pop(0)
+        elif opt == "-m":
+            metrics_path = args.pop(0)
+        else:
+            profile_path = args.pop(0)
+
+    if not args:
+        descriptions = "\n".join("  %s" % fmt.description for fmt in formats)
+        print(USAGE % (argv[0], descriptions + "\n  Nintendo Puzzle Collection disc directory"))
+        return 1
+
+    if archive_path is not None:
+        import archive
+        if archive.archive_kind(archive_path) is None:
+            print("ERROR: Unsupported archive type: %s" % archive_path)
+            return 1
+
+    recorder = metrics.enable() if metrics_path is not None else None
+
+    if profile_path is not None:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+
+    # detect everything first, so outputs of one file are not picked up as
+    # inputs when walking a directory
+    if recorder is not None:
+        recorder.begin(None, "detect")
+    jobs = collect_jobs(args)
+    if recorder is not None:
+        recorder.end()
+
+    output = None
+    if archive_path is not None and not detect_only:
+        output = archive.open_output(archive_path, get_archive_root(jobs, output_dir))
+
+    for path, fmt in jobs:
+        if fmt is None:
+            print("%s: unknown format, skipped" % path)
+            continue
+        if fmt == "puzzle_collection":
+            print("%s: Nintendo Puzzle Collection disc" % path)
+        else:
+            print("%s: %s" % (path, fmt.description))
+        if detect_only:
+            continue
+        if recorder is not None:
+            recorder.begin(path, "puzzle_collection" if fmt == "puzzle_collection" else fmt.name)
+        try:
+            if fmt == "puzzle_collection":
+                extract_puzzle_collection(path, output_dir, output)
+            else:
+                fmt.extract(path, output)
+        finally:
+            if recorder is not None:
+                recorder.end()
+
+    if output is not None:
+        output.close()
+
+    if profile_path is not None:
+        profile.disable()
+
+    if recorder is not None:
+        recorder.save(metrics_path)
+        metrics.disable()
+
+    if profile_path is not None:
+        profile.dump_stats(profile_path)
+
+    return 0
+
+if __name__ == "__main__":
+    main()
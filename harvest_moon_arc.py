@@ -4,64 +4,80 @@ import os
 import sys
 import struct
 
+from binary_reader import iter_records
+from container import Container
+from pipeline import Pipeline
+import metrics
+
 if sys.version_info[0] > 2:
     xrange = range
 
-def read_u32_be(f):
-    try:
-        buf = f.read(4)
-    except EnvironmentError:
-        sys.exit("ERROR: Read error at 0x%08X" % f.tell())
-    return struct.unpack(">I", buf)[0]
+# pool, proj, sdir and song entries of the header: offset, size, unused
+ARC_ENTRY = struct.Struct(">III")
 
-def main(argc=len(sys.argv), argv=sys.argv):
-    if argc < 2:
-        print("Usage: %s <file.arc> [<file.arc> ...]" % argv[0])
-        return 1
+def read_arc_table(f):
+    buf = f.read(4 * ARC_ENTRY.size)
+    if len(buf) != 4 * ARC_ENTRY.size:
+        raise ValueError("Read error at 0x%08X" % f.tell())
+    return [(offset, size) for offset, size, unused in iter_records(ARC_ENTRY, buf, 4)]
 
-    for i in xrange(1, argc):
-        if os.path.isfile(argv[i]) is not True:
-            print("ERROR: Invalid file path: %s" % argv[i])
-            continue
+def extract_arc(path_in, pipeline=None):
+    if pipeline is None:
+        with Pipeline() as pipeline:
+            return extract_arc(path_in, pipeline)
 
-        path_in = os.path.realpath(argv[i])
-        dir_in = os.path.dirname(path_in)
-        basename = os.path.splitext(os.path.basename(path_in))[0]
+    dir_in = os.path.dirname(path_in)
+    basename = os.path.splitext(os.path.basename(path_in))[0]
 
-        with open(path_in, "rb") as arc:
-            arc.seek(0x30)
+    with metrics.open_file(path_in, "rb") as arc:
+        arc.seek(0x30)
 
-            pool_offset = read_u32_be(arc)
-            pool_size = read_u32_be(arc)
-            arc.seek(4, os.SEEK_CUR)
+        with metrics.phase("table"):
+            table = read_arc_table(arc)
 
-            proj_offset = read_u32_be(arc)
-            proj_size = read_u32_be(arc)
-            arc.seek(4, os.SEEK_CUR)
+        for ext, (offset, size) in zip(("pool", "proj", "sdir", "song"), table):
+            path_out = os.path.join(dir_in, "%s.%s" % (basename, ext))
+            arc.seek(offset)
+            # timed until the pipeline has written it
+            timer = metrics.member(path_out, size)
+            pipeline.submit(path_out, arc.read(size), timer)
 
-            sdir_offset = read_u32_be(arc)
-            sdir_size = read_u32_be(arc)
-            arc.seek(4, os.SEEK_CUR)
+def open_container(path_in):
+    basename = os.path.splitext(os.path.basename(path_in))[0]
 
-            song_offset = read_u32_be(arc)
-            song_size = read_u32_be(arc)
-            arc.seek(4, os.SEEK_CUR)
+    container = Container()
+    try:
+        fd = container.add_source(path_in)
+
+        with metrics.open_file(path_in, "rb") as arc:
+            arc.seek(0x30)
+            table = read_arc_table(arc)
 
-            arc.seek(pool_offset)
-            with open(os.path.join(dir_in, basename+".pool"), "wb") as pool:
-                pool.write(arc.read(pool_size))
+        for ext, (offset, size) in zip(("pool", "proj", "sdir", "song"), table):
+            container.add_range("%s.%s" % (basename, ext), fd, offset, size)
+    except:
+        container.close()
+        raise
 
-            arc.seek(proj_offset)
-            with open(os.path.join(dir_in, basename+".proj"), "wb") as proj:
-                proj.write(arc.read(proj_size))
+    return container
 
-            arc.seek(sdir_offset)
-            with open(os.path.join(dir_in, basename+".sdir"), "wb") as sdir:
-                sdir.write(arc.read(sdir_size))
+def main(argc=len(sys.argv), argv=sys.argv):
+    if argc < 2:
+        print("Usage: %s <file.arc> [<file.arc> ...]" % argv[0])
+        return 1
 
-            arc.seek(song_offset)
-            with open(os.path.join(dir_in, basename+".song"), "wb") as song:
-                song.write(arc.read(song_size))
+    # one pipeline for the whole batch, so the next arc is read while the
+    # sections of the previous ones are still being written
+    with Pipeline() as pipeline:
+        for i in xrange(1, argc):
+            if os.path.isfile(argv[i]) is not True:
+                print("ERROR: Invalid file path: %s" % argv[i])
+                continue
+
+            try:
+                extract_arc(os.path.realpath(argv[i]), pipeline)
+            except ValueError as e:
+                print("ERROR: %s: %s" % (argv[i], e))
 
     print("No more files to process.")
 
@@ -3,17 +3,21 @@
 
 import os
 import sys
-import struct
 
-def get_u32_be(buf, off):
-  return struct.unpack(">I", buf[off:off+4])[0]
+from binary_reader import get_u32_be
+from container import Container
+import metrics
 
-def dump_file(path, buf):
-  with open(path, "wb") as f:
-    f.write(buf)
+def dump_file(path, buf, output=None):
+  with metrics.member(path, len(buf)):
+    if output is None:
+      with metrics.open_file(path, "wb") as f:
+        f.write(buf)
+    else:
+      output.submit(path, buf)
 
-def extract(in_path):
-  with open(in_path, "rb") as pps:
+def extract(in_path, output=None):
+  with metrics.open_file(in_path, "rb") as pps:
     ppsbuf = pps.read()
 
   if get_u32_be(ppsbuf, 0x04) == 3:
@@ -23,12 +27,33 @@ def extract(in_path):
 
     stem = os.path.splitext(in_path)[0]
 
-    dump_file("%s.pool" % stem, ppsbuf[pool_off:proj_off])
-    dump_file("%s.proj" % stem, ppsbuf[proj_off:sdir_off])
-    dump_file("%s.sdir" % stem, ppsbuf[sdir_off:len(ppsbuf)])
+    dump_file("%s.pool" % stem, ppsbuf[pool_off:proj_off], output)
+    dump_file("%s.proj" % stem, ppsbuf[proj_off:sdir_off], output)
+    dump_file("%s.sdir" % stem, ppsbuf[sdir_off:len(ppsbuf)], output)
   else:
     input("Number at 0x04 != 0x03 in file %s" % in_path)
 
+def open_container(in_path):
+  with metrics.open_file(in_path, "rb") as pps:
+    header = pps.read(0x14)
+    size = os.fstat(pps.fileno()).st_size
+
+  if len(header) < 0x14 or get_u32_be(header, 0x04) != 3:
+    raise ValueError("Number at 0x04 != 0x03 in file %s" % in_path)
+
+  pool_off = get_u32_be(header, 0x08)
+  proj_off = get_u32_be(header, 0x0C)
+  sdir_off = get_u32_be(header, 0x10)
+
+  stem = os.path.splitext(os.path.basename(in_path))[0]
+
+  container = Container()
+  fd = container.add_source(in_path)
+  container.add_range("%s.pool" % stem, fd, pool_off, max(0, proj_off - pool_off))
+  container.add_range("%s.proj" % stem, fd, proj_off, max(0, sdir_off - proj_off))
+  container.add_range("%s.sdir" % stem, fd, sdir_off, max(0, size - sdir_off))
+  return container
+
 def main(argc=len(sys.argv), argv=sys.argv):
   if argc < 2:
     print("Usage: %s <pps_file|pps_dir> [...]" % argv[0])
@@ -0,0 +1,216 @@
+# Optional run metrics for the extractors
+#
+# Nothing is recorded unless enable() is called; until then the hooks the
+# extractors call are no-ops. Once enabled, a report is kept per input with
+# phase timings and per-member latencies, and I/O is counted where it is done:
+# by the shared helpers (Container reads, copy_segment and the writer
+# pipeline) and through the files the extractors open with open_file(). Reads
+# through an mmap are not counted.
+
+import json
+import time
+import threading
+
+IO_COUNTERS = ("opens", "seeks", "reads", "bytes_read", "writes", "bytes_written")
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def done(self):
+        pass
+
+null_timer = NullTimer()
+
+class PhaseTimer:
+    def __init__(self, report, name):
+        self.report = report
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.done()
+
+    def done(self):
+        elapsed = time.perf_counter() - self.start
+        phases = self.report["phases"]
+        phases[self.name] = phases.get(self.name, 0.0) + elapsed
+
+class MemberTimer:
+    # timed from creation to done(), for members written a piece at a time
+    def __init__(self, report, name, size):
+        self.report = report
+        self.name = name
+        self.size = size
+        self.start = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.done()
+
+    def done(self):
+        elapsed = time.perf_counter() - self.start
+        self.report["members"].append({"name": self.name, "size": self.size, "seconds": elapsed})
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reports = []
+        self.report = None
+
+    def new_report(self, path, fmt):
+        report = {
+            "input": path,
+            "format": fmt,
+            "seconds": 0.0,
+            "phases": {},
+            "io": dict((key, 0) for key in IO_COUNTERS),
+            "members": [],
+        }
+        self.reports.append(report)
+        return report
+
+    def current(self):
+        # hooks used outside of begin()/end() go to a report of their own
+        if self.report is None:
+            self.report = self.new_report(None, None)
+        return self.report
+
+    def begin(self, path, fmt=None):
+        self.report = self.new_report(path, fmt)
+        self.start = time.perf_counter()
+
+    def end(self):
+        self.report["seconds"] = time.perf_counter() - self.start
+        self.report = None
+
+    def count(self, key, n=1, report=None):
+        with self.lock:
+            (report or self.current())["io"][key] += n
+
+    def count_read(self, n, report=None):
+        with self.lock:
+            io = (report or self.current())["io"]
+            io["reads"] += 1
+            io["bytes_read"] += n
+
+    def count_write(self, n, report=None):
+        with self.lock:
+            io = (report or self.current())["io"]
+            io["writes"] += 1
+            io["bytes_written"] += n
+
+    def summary(self):
+        totals = dict((key, 0) for key in IO_COUNTERS)
+        phases = {}
+        for report in self.reports:
+            for key in IO_COUNTERS:
+                totals[key] += report["io"][key]
+            for name, seconds in report["phases"].items():
+                phases[name] = phases.get(name, 0.0) + seconds
+        return {
+            "inputs": len(self.reports),
+            "seconds": sum(report["seconds"] for report in self.reports),
+            "members": sum(len(report["members"]) for report in self.reports),
+            "phases": phases,
+            "io": totals,
+            # slowest first, to find the inputs worth looking at
+            "slowest": [report["input"] for report in sorted(self.reports, key=lambda report: -report["seconds"])
+                        if report["input"] is not None][:10],
+        }
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({"summary": self.summary(), "reports": self.reports}, f, indent=2)
+
+recorder = None
+
+def phase(name):
+    if recorder is None:
+        return null_timer
+    return PhaseTimer(recorder.current(), name)
+
+def member(name, size):
+    if recorder is None:
+        return null_timer
+    return MemberTimer(recorder.current(), name, size)
+
+def current_report():
+    # where I/O done now belongs, for work finished later by another thread
+    if recorder is None:
+        return None
+    return recorder.current()
+
+def count(key, n=1, report=None):
+    if recorder is not None:
+        recorder.count(key, n, report)
+
+def count_read(n, report=None):
+    if recorder is not None:
+        recorder.count_read(n, report)
+
+def count_write(n, report=None):
+    if recorder is not None:
+        recorder.count_write(n, report)
+
+class CountingFile:
+    def __init__(self, f):
+        self._f = f
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+    def __iter__(self):
+        return iter(self._f)
+
+    def __enter__(self):
+        self._f.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._f.__exit__(*exc)
+
+    def read(self, *args):
+        data = self._f.read(*args)
+        count_read(len(data))
+        return data
+
+    def readinto(self, b):
+        n = self._f.readinto(b)
+        count_read(n or 0)
+        return n
+
+    def write(self, data):
+        n = self._f.write(data)
+        count_write(len(data) if n is None else n)
+        return n
+
+    def seek(self, *args):
+        count("seeks")
+        return self._f.seek(*args)
+
+def open_file(*args, **kwargs):
+    # open() for the files an extractor reads and writes itself
+    f = open(*args, **kwargs)
+    if recorder is None:
+        return f
+    count("opens")
+    return CountingFile(f)
+
+def enable():
+    global recorder
+    if recorder is None:
+        recorder = Recorder()
+    return recorder
+
+def disable():
+    global recorder
+    recorder = None
@@ -2,7 +2,11 @@
 
 import os
 import sys
-import struct
+import collections
+
+from binary_reader import get_u32_le, get_u32_table_le
+from container import Container, DEFAULT_WORKERS, pread
+import metrics
 
 namemap = {
     "Sound_Device_Library" : "libsd",
@@ -15,43 +19,144 @@ namemap = {
 OFF_COUNT = 0x00
 OFF_SZTBL = 0x04
 
-def get_u32_le(buf, off):
-    return struct.unpack("<I", buf[off:off+4])[0]
-
-def get_c_str(buf, off):
-    end = off
+OFF_NAME = 0x8E
+NAME_READ_SIZE = 0x40
+ALIGNMENT = 0x10
 
-    while buf[end] != 0:
-        end += 1
+USAGE = """Usage: %s [-l] [-o <output_dir>] [-j <workers>] <irxpack.bin> [<module> ...]
 
-    return buf[off:end].decode("ASCII")
+  -l  list the module table instead of extracting
+  -o  directory to write modules to (default: next to irxpack.bin)
+  -j  number of modules to extract at once (default: %d)
 
-def main(argc=len(sys.argv), argv=sys.argv):
-    if argc != 2:
-        print("Usage: %s <irxpack.bin>" % argv[0])
-        return 1
+If module names are given, only those modules are listed/extracted."""
 
-    inpath = os.path.realpath(argv[1])
-    os.chdir( os.path.dirname(inpath) )
+IrxModule = collections.namedtuple("IrxModule", "index name offset size padding")
 
-    with open(inpath, "rb") as bin:
-        buf = bin.read()
+def pread_c_str(fd, off):
+    # read the name in small bounded pieces instead of loading the module
+    buf = b""
+    while True:
+        piece = pread(fd, NAME_READ_SIZE, off + len(buf))
+        end = piece.find(b"\0")
+        if end >= 0:
+            return (buf + piece[:end]).decode("ASCII")
+        if len(piece) < NAME_READ_SIZE:
+            raise EOFError("Unterminated module name at 0x%08X" % off)
+        buf += piece
 
-    irxcount = get_u32_le(buf, OFF_COUNT)
+def read_module_table(fd):
+    irxcount = get_u32_le(pread(fd, 4, OFF_COUNT), 0)
+    sizes = get_u32_table_le(pread(fd, irxcount * 4, OFF_SZTBL), irxcount)
     offset = OFF_SZTBL + irxcount * 4
 
+    modules = []
+
     for i in range(irxcount):
-        offset = ((offset - 1) & ~0xF) + 0x10
-        size = get_u32_le(buf, OFF_SZTBL+i*4)
-        name = get_c_str(buf, offset+0x8E)
+        aligned = ((offset - 1) & ~(ALIGNMENT - 1)) + ALIGNMENT
+        size = sizes[i]
+        name = pread_c_str(fd, aligned+OFF_NAME)
 
         if name in namemap:
             name = namemap[name]
 
-        with open("%s.irx" % name, "wb") as irx:
-            irx.write(buf[offset:offset+size])
+        modules.append(IrxModule(i, name, aligned, size, aligned - offset))
+
+        offset = aligned + size
+
+    return modules
+
+def select_modules(modules, names):
+    if not names:
+        return modules, []
+    wanted = set(os.path.splitext(name)[0] if name.lower().endswith(".irx") else name for name in names)
+    selected = [module for module in modules if module.name in wanted]
+    missing = sorted(wanted - set(module.name for module in selected))
+    return selected, missing
+
+def extract_modules(fd, modules, outdir, workers=DEFAULT_WORKERS, output=None):
+    if output is None and not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    # modules are read with positioned reads, so they can all share fd
+    container = Container()
+    for module in modules:
+        container.add_range("%s.irx" % module.name, fd, module.offset, module.size)
+    return container.extract(outdir, workers=workers, output=output)
+
+def extract_irxpack(inpath, outdir=None, names=(), workers=DEFAULT_WORKERS, output=None):
+    if outdir is None:
+        outdir = os.path.dirname(inpath)
+
+    fd = os.open(inpath, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    metrics.count("opens")
+
+    try:
+        with metrics.phase("table"):
+            modules, missing = select_modules(read_module_table(fd), names)
+        extract_modules(fd, modules, outdir, workers, output)
+    finally:
+        os.close(fd)
+
+    return modules, missing
+
+def open_container(inpath):
+    container = Container()
+    try:
+        fd = container.add_source(inpath)
+        for module in read_module_table(fd):
+            container.add_range("%s.irx" % module.name, fd, module.offset, module.size)
+    except:
+        container.close()
+        raise
+    return container
+
+def main(argc=len(sys.argv), argv=sys.argv):
+    args = argv[1:argc]
+    list_only = False
+    outdir = None
+    workers = DEFAULT_WORKERS
+
+    while args and args[0] in ("-l", "-o", "-j"):
+        opt = args.pop(0)
+        if opt == "-l":
+            list_only = True
+        elif not args:
+            pass
+        elif opt == "-o":
+            outdir = os.path.realpath(args.pop(0))
+        else:
+            workers = max(1, int(args.pop(0)))
+
+    if not args:
+        print(USAGE % (argv[0], DEFAULT_WORKERS))
+        return 1
+
+    inpath = os.path.realpath(args[0])
+
+    if outdir is None:
+        outdir = os.path.dirname(inpath)
+
+    fd = os.open(inpath, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    metrics.count("opens")
+
+    try:
+        modules, missing = select_modules(read_module_table(fd), args[1:])
+
+        for name in missing:
+            print("ERROR: No such module: %s" % name)
+
+        if list_only:
+            print("%-4s %-10s %-10s %-6s %s" % ("#", "offset", "size", "pad", "name"))
+            for module in modules:
+                print("%-4d 0x%08X 0x%08X 0x%-4X %s" % (module.index, module.offset, module.size, module.padding, module.name))
+            return 0
+
+        extract_modules(fd, modules, outdir, workers)
+    finally:
+        os.close(fd)
 
-        offset += size
+    return 0
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,8 +1,20 @@
 import os
+import re
 import sys
-import shutil
+import json
+import mmap
+import struct
+import hashlib
+import collections
+import concurrent.futures
 
-USAGE = """Usage: nintendo_puzzle_collection_musyx.py <extracted_iso> <output_dir>
+from binary_reader import u16_be, u32_be, s16_be
+from container import Container, DEFAULT_WORKERS, OUTPUT_FLAGS, copy_segment
+from pipeline import Pipeline
+import metrics
+
+USAGE = """Usage: nintendo_puzzle_collection_musyx.py [-j <workers>] <extracted_iso> <output_dir>
+       nintendo_puzzle_collection_musyx.py -s <file> [<file> ...]
 
 <extracted_iso> must be the path to a directory containing an exact replica of
 the filesystem on the original game dise. Specifically, the following files are
@@ -24,8 +36,15 @@ ycookie.bin
 <output_dir> is the destination directory into which organized MusyX data will
 be extracted.
 
+-j sets how many members are hashed at once (default: 8).
+
 This script only officially supports the version of the game with serial number
 DL-DOL-GPZJ-JPN
+
+With -s, the given files (e.g. .plf/.rel executables of another version) are
+scanned for embedded MusyX pool/proj/sdir/song blocks instead, and a table in
+the format of the metadata below is printed. Song boundaries are estimated from
+the song headers, so check the table before using it.
 """
 
 """
@@ -399,13 +418,491 @@ def verify_game_dir(input_dirpath):
         return False
   return True
 
+MANIFEST_NAME = "manifest.json"
+
+def plan_extraction(root_input_dir, root_output_dir, make_dirs=True):
+  # group every output by the file it comes from, in the order the data
+  # appears in that file, so each input is opened and walked once
+  plan = collections.OrderedDict()
+  for output_dirname in meta:
+    output_dirpath = os.path.join(root_output_dir, output_dirname)
+    if make_dirs and not os.path.isdir(output_dirpath):
+      os.makedirs(output_dirpath)
+    for input_relpath in meta[output_dirname]:
+      for offset, size, output_filename in meta[output_dirname][input_relpath]:
+        output_path = os.path.join(output_dirpath, output_filename)
+        output_key = "%s/%s" % (output_dirname, output_filename)
+        plan.setdefault(input_relpath, []).append((offset, size, output_path, output_key))
+  for entries in plan.values():
+    entries.sort(key=lambda entry: entry[0])
+  return plan
+
+def load_manifest(path):
+  try:
+    with open(path, "r") as f:
+      manifest = json.load(f)
+  except (IOError, ValueError):
+    manifest = {}
+  manifest.setdefault("sources", {})
+  manifest.setdefault("outputs", {})
+  return manifest
+
+def save_manifest(path, manifest):
+  with open(path, "w") as f:
+    json.dump(manifest, f, indent=2, sort_keys=True)
+
+def is_current(record, input_relpath, offset, size, output_path):
+  # whether the output is still what the manifest says was extracted; if
+  # the input was touched since, its data has to be compared as well
+  if record is None:
+    return False
+  if record["source"] != input_relpath or record["offset"] != offset or record["size"] != size:
+    return False
+  return os.path.isfile(output_path) and os.path.getsize(output_path) == record["length"]
+
+class SharedPayloads:
+  # outputs with identical contents are written once and hard linked
+  def __init__(self):
+    self.paths = {}
+    self.num_linked = 0
+    self.bytes_saved = 0
+
+  def add(self, sha1, path):
+    self.paths.setdefault(sha1, path)
+
+  def link(self, sha1, path, length):
+    src = self.paths.get(sha1)
+    if src is None or not os.path.isfile(src):
+      return False
+    try:
+      os.link(src, path)
+    except (OSError, AttributeError):
+      return False
+    self.num_linked += 1
+    self.bytes_saved += length
+    return True
+
+def hash_view(view):
+  return hashlib.sha1(view).hexdigest()
+
+def copy_file(fd, output_path, size):
+  out_fd = os.open(output_path, OUTPUT_FLAGS, 0o666)
+  metrics.count("opens")
+  try:
+    copy_segment(fd, 0, size, out_fd)
+  finally:
+    os.close(out_fd)
+
+def extract_input(input_abspath, input_relpath, entries, manifest, shared, pipeline, workers=DEFAULT_WORKERS):
+  st = os.stat(input_abspath)
+  source_state = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+  source_changed = manifest["sources"].get(input_relpath) != source_state
+
+  fd = os.open(input_abspath, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+  metrics.count("opens")
+  mapped = None
+  members = []
+  try:
+    if st.st_size:
+      mapped = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped if mapped is not None else b"")
+
+    # every member is a view of the one mapping, read by whoever touches it
+    # first; a pool of threads hashes the ones that have to be checked, ahead
+    # of the in-order loop below that links and writes them
+    current = []
+    for offset, size, output_path, output_key in entries:
+      record = manifest["outputs"].get(output_key)
+      current.append(is_current(record, input_relpath, offset, size, output_path))
+      if offset == -1 and size == -1:
+        members.append(view[:])
+      else:
+        members.append(view[offset:offset+size])
+    view.release()
+    to_hash = []
+    if shared is not None:
+      to_hash = [member for member, is_unchanged in zip(members, current) if source_changed or not is_unchanged]
+
+    try:
+      with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        digests = pool.map(hash_view, to_hash)
+        for (offset, size, output_path, output_key), is_unchanged, data in zip(entries, current, members):
+          print("%s ... " % output_path, end="")
+          record = manifest["outputs"].get(output_key)
+          if not source_changed and is_unchanged:
+            shared.add(record["sha1"], output_path)
+            print("up to date")
+            continue
+          length = len(data)
+          timer = metrics.member(output_path, length)
+          if shared is None:
+            # into an archive: every member is written, nothing is kept track of
+            pipeline.submit(output_path, data, timer)
+            print("OK")
+            continue
+          sha1 = next(digests)
+          if is_unchanged and sha1 == record["sha1"]:
+            # the input was touched, but this member is still the same
+            timer.done()
+            shared.add(sha1, output_path)
+            print("up to date")
+            continue
+          # never write through an existing name, it may be a link to another output
+          if os.path.lexists(output_path):
+            os.remove(output_path)
+          if sha1 in shared.paths:
+            # the first copy may still be waiting to be written
+            pipeline.wait()
+          if shared.link(sha1, output_path, length):
+            status = "linked"
+            timer.done()
+          else:
+            if offset == -1 and size == -1:
+              # whole files are copied by the kernel
+              copy_file(fd, output_path, length)
+              timer.done()
+            else:
+              # written from the mapping by a pipeline thread, which is then
+              # done with the timer
+              pipeline.submit(output_path, data, timer)
+            shared.add(sha1, output_path)
+            status = "OK"
+          manifest["outputs"][output_key] = {
+            "source": input_relpath,
+            "offset": offset,
+            "size": size,
+            "length": length,
+            "sha1": sha1,
+          }
+          print(status)
+    finally:
+      # the pipeline writes from the mapping, so it has to be done with it
+      # (on a write error too) before the mapping can be closed
+      pipeline.wait()
+  finally:
+    data = to_hash = None
+    del members[:]
+    try:
+      if mapped is not None:
+        try:
+          mapped.close()
+        except BufferError as e:
+          # an error on its way out may hold views of the mapping in its
+          # traceback; the mapping then goes when they do
+          if e.__context__ is None:
+            raise
+    finally:
+      os.close(fd)
+
+  manifest["sources"][input_relpath] = source_state
+
+# pool: u32 offsets to the sound macro, table, keymap and layer sections;
+# the macros always directly follow the header
+POOL_ID = re.compile(b"(?=\x00\x00\x00\x10)")
+
+MAX_POOL_OBJECT_SIZE = 0x10000
+MAX_PROJ_GROUPS = 0x400
+MAX_SDIR_ENTRIES = 0x1000
+MAX_SONG_REGIONS = 0x1000
+
+# how far past the sdir (or the previous song) to look for a song header
+SONG_SEARCH_WINDOW = 0x1000
+
+def parse_pool(buf, off, limit):
+  if off + 0x10 > limit:
+    return None
+  sections = struct.unpack_from(">4I", buf, off)
+  if sections[0] != 0x10:
+    return None
+  end = off + 0x10
+  for section in sections:
+    if section == 0:
+      continue
+    pos = off + section
+    if section & 3 or pos < end or pos >= limit:
+      return None
+    # objects are {u32 size, u16 id, u16 pad, ...}, ended by a size of ~0
+    while True:
+      if pos + 4 > limit:
+        return None
+      size = u32_be.unpack_from(buf, pos)[0]
+      if size == 0xFFFFFFFF:
+        pos += 4
+        break
+      if size < 8 or size > MAX_POOL_OBJECT_SIZE or pos + size > limit:
+        return None
+      pos += size
+    end = pos
+  return end - off
+
+def parse_proj(buf, off, limit):
+  # a chain of 0x28-byte group headers, each starting with the offset of
+  # the next one, ended by ~0
+  pos = off
+  for i in range(MAX_PROJ_GROUPS + 1):
+    if pos + 4 > limit:
+      return None
+    next_off = u32_be.unpack_from(buf, pos)[0]
+    if next_off == 0xFFFFFFFF:
+      return pos + 4 - off if i else None
+    if next_off & 3 or off + next_off < pos + 0x28 or off + next_off > limit:
+      return None
+    if u16_be.unpack_from(buf, pos+0x06)[0] > 1:
+      return None
+    pos = off + next_off
+  return None
+
+def parse_sdir(buf, off, limit):
+  # 0x20-byte sample entries ended by an id of 0xFFFF, followed by the
+  # 0x28-byte DSP ADPCM parameters of every sample
+  num_entries = 0
+  param_end = 0
+  pos = off
+  while True:
+    if pos + 2 > limit or num_entries > MAX_SDIR_ENTRIES:
+      return None
+    if u16_be.unpack_from(buf, pos)[0] == 0xFFFF:
+      break
+    if pos + 0x20 > limit:
+      return None
+    sample_rate = u16_be.unpack_from(buf, pos+0x0E)[0]
+    param_off = u32_be.unpack_from(buf, pos+0x1C)[0]
+    if not 1000 <= sample_rate <= 48000:
+      return None
+    param_end = max(param_end, param_off + 0x28)
+    num_entries += 1
+    pos += 0x20
+  if num_entries == 0:
+    return None
+  params_start = pos + 4 - off
+  if param_end < params_start + num_entries * 0x28 or off + param_end > limit:
+    return None
+  return param_end
+
+def parse_song(buf, off, limit):
+  # header: u32 track index, region index, channel map and tempo table
+  # offsets, initial tempo, unknown offset
+  if off + 0x18 > limit:
+    return None
+  trk_off, reg_off, chan_off, tempo_off = struct.unpack_from(">4I", buf, off)
+  max_off = limit - off
+  if not (0x18 <= trk_off <= max_off - 0x100 and 0x18 <= reg_off < max_off and 0x18 <= chan_off <= max_off - 0x40):
+    return None
+  if tempo_off and not 0x18 <= tempo_off < max_off:
+    return None
+  tracks = struct.unpack_from(">64I", buf, off+trk_off)
+  if not any(tracks):
+    return None
+  end = max(trk_off + 0x100, chan_off + 0x40)
+  num_regions = 0
+  for track in tracks:
+    if track == 0:
+      continue
+    if not 0x18 <= track < max_off:
+      return None
+    # 12-byte track regions, the last one has a region index of -1
+    pos = off + track
+    for i in range(MAX_SONG_REGIONS):
+      if pos + 12 > limit:
+        return None
+      region = s16_be.unpack_from(buf, pos+0x08)[0]
+      pos += 12
+      if region == -1:
+        break
+      if region < 0:
+        return None
+      num_regions = max(num_regions, region + 1)
+    else:
+      return None
+    end = max(end, pos - off)
+  if reg_off + num_regions * 4 > max_off:
+    return None
+  end = max(end, reg_off + num_regions * 4)
+  for region_off in struct.unpack_from(">%dI" % num_regions, buf, off+reg_off):
+    # region data: u32 size, pitch and mod wheel offsets, then size bytes
+    if region_off == 0:
+      continue
+    if not 0x18 <= region_off <= max_off - 12:
+      return None
+    region_end = region_off + 12 + u32_be.unpack_from(buf, off+region_off)[0]
+    if region_end > max_off:
+      return None
+    end = max(end, region_end)
+  if tempo_off:
+    pos = off + tempo_off
+    while True:
+      if pos + 8 > limit:
+        return None
+      tick = u32_be.unpack_from(buf, pos)[0]
+      pos += 8
+      if tick == 0xFFFFFFFF:
+        break
+    end = max(end, pos - off)
+  return (end + 3) & ~3
+
+def find_song(buf, start, limit):
+  for off in range((start + 3) & ~3, min(start + SONG_SEARCH_WINDOW, limit), 4):
+    size = parse_song(buf, off, limit)
+    if size:
+      return off, size
+  return None
+
+def locate_musyx_blocks(buf):
+  limit = len(buf)
+  groups = []
+  resume = 0
+
+  for match in POOL_ID.finditer(buf):
+    pool_off = match.start()
+    if pool_off & 3 or pool_off < resume:
+      continue
+    pool_size = parse_pool(buf, pool_off, limit)
+    if not pool_size:
+      continue
+    proj_off = pool_off + pool_size
+    proj_size = parse_proj(buf, proj_off, limit)
+    if not proj_size:
+      continue
+    sdir_off = proj_off + proj_size
+    sdir_size = parse_sdir(buf, sdir_off, limit)
+    if not sdir_size:
+      continue
+
+    groups.append({
+      "pool": (pool_off, pool_size),
+      "proj": (proj_off, proj_size),
+      "sdir": (sdir_off, sdir_size),
+      "songs": [],
+    })
+    resume = sdir_off + sdir_size
+
+  # songs follow their sdir, up to the next group
+  for i, group in enumerate(groups):
+    song_limit = groups[i+1]["pool"][0] if i + 1 < len(groups) else limit
+    pos = sum(group["sdir"])
+    while True:
+      song = find_song(buf, pos, song_limit)
+      if song is None:
+        break
+      group["songs"].append(song)
+      pos = sum(song)
+
+  return groups
+
+def scan_meta(paths):
+  scanned = collections.OrderedDict()
+  for path in paths:
+    stem = os.path.splitext(os.path.basename(path))[0]
+    entries = []
+    with metrics.open_file(path, "rb") as f:
+      if os.fstat(f.fileno()).st_size == 0:
+        continue
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        groups = locate_musyx_blocks(buf)
+    for groupnum, group in enumerate(groups):
+      name = "%s_%02d" % (stem, groupnum)
+      for kind in ("pool", "proj", "sdir"):
+        entries.append(group[kind] + ("%s.%s" % (name, kind),))
+      songs = group["songs"]
+      for songnum, song in enumerate(songs):
+        if len(songs) > 1:
+          entries.append(song + ("%s_%02d.song" % (name, songnum),))
+        else:
+          entries.append(song + ("%s.song" % name,))
+    if entries:
+      scanned.setdefault(stem.lower(), collections.OrderedDict())["/" + os.path.basename(path)] = entries
+  return scanned
+
+def print_meta(scanned):
+  print("meta = {")
+  for output_dirname in scanned:
+    print('  "%s": {' % output_dirname)
+    for input_relpath in scanned[output_dirname]:
+      print('    "%s": [' % input_relpath)
+      for offset, size, output_filename in scanned[output_dirname][input_relpath]:
+        print('      (0x%X, 0x%X, "%s"),' % (offset, size, output_filename))
+      print("    ],")
+    print("  },")
+  print("}")
+
+def open_container(root_input_dir):
+  # members are named "<output_dirname>/<output_name>", as laid out on disk
+  container = Container()
+  try:
+    fds = {}
+    for output_dirname in meta:
+      for input_relpath in meta[output_dirname]:
+        if input_relpath not in fds:
+          input_abspath = os.path.join(root_input_dir, input_relpath.lstrip("\\/"))
+          fds[input_relpath] = (container.add_source(input_abspath), os.path.getsize(input_abspath))
+        fd, input_size = fds[input_relpath]
+        for offset, size, output_filename in meta[output_dirname][input_relpath]:
+          name = "%s/%s" % (output_dirname, output_filename)
+          if offset == -1 and size == -1:
+            container.add_range(name, fd, 0, input_size)
+          else:
+            container.add_range(name, fd, offset, size)
+  except:
+    container.close()
+    raise
+  return container
+
+def extract_game(root_input_dir, root_output_dir, workers=DEFAULT_WORKERS, output=None):
+  if output is not None:
+    # no manifest and no links, as there are no earlier outputs to go by
+    with metrics.phase("plan"):
+      plan = plan_extraction(root_input_dir, root_output_dir, make_dirs=False)
+    print("Extracting:")
+    for input_relpath, entries in plan.items():
+      input_abspath = os.path.join(root_input_dir, input_relpath.lstrip("\\/"))
+      extract_input(input_abspath, input_relpath, entries, {"sources": {}, "outputs": {}}, None, output, workers)
+    return
+
+  manifest_path = os.path.join(root_output_dir, MANIFEST_NAME)
+  manifest = load_manifest(manifest_path)
+
+  with metrics.phase("plan"):
+    plan = plan_extraction(root_input_dir, root_output_dir)
+
+  # forget outputs that are no longer in meta
+  output_keys = set(entry[3] for entries in plan.values() for entry in entries)
+  for output_key in list(manifest["outputs"]):
+    if output_key not in output_keys:
+      del manifest["outputs"][output_key]
+
+  shared = SharedPayloads()
+
+  print("Extracting:")
+
+  try:
+    with Pipeline() as pipeline:
+      for input_relpath, entries in plan.items():
+        input_abspath = os.path.join(root_input_dir, input_relpath.lstrip("\\/"))
+        extract_input(input_abspath, input_relpath, entries, manifest, shared, pipeline, workers)
+  finally:
+    save_manifest(manifest_path, manifest)
+
+  if shared.num_linked:
+    print("Linked %d duplicate outputs, saved %d bytes" % (shared.num_linked, shared.bytes_saved))
+
 def main(argc=len(sys.argv), argv=sys.argv):
-  if argc != 3:
+  if argc >= 3 and argv[1] == "-s":
+    print_meta(scan_meta([os.path.realpath(path) for path in argv[2:argc]]))
+    return 0
+
+  args = argv[1:argc]
+  workers = DEFAULT_WORKERS
+
+  if len(args) == 4 and args[0] == "-j":
+    workers = max(1, int(args[1]))
+    args = args[2:]
+
+  if len(args) != 2:
     print(USAGE)
     return 1
 
-  root_input_dir = os.path.realpath(argv[1])
-  root_output_dir = os.path.realpath(argv[2])
+  root_input_dir = os.path.realpath(args[0])
+  root_output_dir = os.path.realpath(args[1])
 
   if not verify_game_dir(root_input_dir):
     print(USAGE)
@@ -418,25 +915,7 @@ def main(argc=len(sys.argv), argv=sys.argv):
   except:
     sys.exit("Fatal error creating output directories!")
 
-  print("Extracting:")
-  
-  for output_dirname in meta:
-    output_dirpath = os.path.join(root_output_dir, output_dirname)
-    if not os.path.isdir(output_dirpath):
-      os.makedirs(output_dirpath)
-    for input_relpath in meta[output_dirname]:
-      input_abspath = os.path.join(root_input_dir, input_relpath.lstrip("\\/"))
-      for offset, size, output_filename in meta[output_dirname][input_relpath]:
-        output_path = os.path.join(output_dirpath, output_filename)
-        print("%s ... " % output_path, end="")
-        if offset == -1 and size == -1:
-          shutil.copyfile(input_abspath, output_path)
-        else:
-          with open(input_abspath, "rb") as fi:
-            fi.seek(offset)
-            with open(output_path, "wb") as fo:
-              fo.write(fi.read(size))
-        print("OK")
+  extract_game(root_input_dir, root_output_dir, workers)
 
   return 0
 
@@ -0,0 +1,198 @@
+# Bounded read/write pipeline for the extractors
+#
+# The extractor thread reads members and hands their data to a pool of writer
+# threads through a queue, so reading the next member overlaps with writing
+# the previous ones. The bytes handed over but not yet written are capped;
+# once the cap is reached the reader waits for the writers (back-pressure).
+#
+# A member is written as one or more pieces, each at its own offset with a
+# positioned write, so the pieces of a large member can be written by any
+# thread in any order without holding the whole member in memory. A member's
+# timer is done once its last piece is written, and the writes are counted in
+# the metrics report of whichever input handed them over.
+
+import os
+import queue
+import threading
+import traceback
+
+import metrics
+
+DEFAULT_WORKERS = 4
+
+DEFAULT_MAX_IN_FLIGHT = 64 * 1024 * 1024
+
+# a member being written piecewise is handed over at least this much at a time
+PIECE_SIZE = 8 * 1024 * 1024
+
+OPEN_FLAGS = os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0)
+
+def write_at(fd, data, offset, report=None):
+    view = memoryview(data).cast("B")
+    while view:
+        if hasattr(os, "pwrite"):
+            n = os.pwrite(fd, view, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            metrics.count("seeks", report=report)
+            n = os.write(fd, view)
+        metrics.count_write(n, report)
+        view = view[n:]
+        offset += n
+
+def write_piece(path, offset, pieces, length=None, report=None):
+    # length is given with the last piece of a member; anything past it is
+    # left over from an earlier, longer file of the same name
+    fd = os.open(path, OPEN_FLAGS, 0o666)
+    metrics.count("opens", report=report)
+    try:
+        for data in pieces:
+            write_at(fd, data, offset, report)
+            offset += len(data)
+        if length is not None:
+            os.ftruncate(fd, length)
+    finally:
+        os.close(fd)
+
+class PendingMember:
+    # the pieces of a member not written yet, and whether the last one has
+    # been handed over
+    def __init__(self, timer):
+        self.timer = timer
+        self.report = metrics.current_report()
+        self.num_pieces = 0
+        self.closed = False
+
+class MemberWriter:
+    # file-like: write() the member in order, then close()
+    def __init__(self, pipeline, path, timer=metrics.null_timer):
+        self.pipeline = pipeline
+        self.path = path
+        self.member = PendingMember(timer)
+        self.offset = 0
+        self.pieces = []
+        self.pending = 0
+
+    def write(self, data):
+        self.pieces.append(data)
+        self.pending += len(data)
+        if self.pending >= PIECE_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self, last=False):
+        length = self.offset + self.pending if last else None
+        self.pipeline.put((self.path, self.offset, self.pieces, length, self.member), self.pending)
+        self.offset += self.pending
+        self.pieces = []
+        self.pending = 0
+
+    def close(self):
+        if self.pieces is not None:
+            self.flush(last=True)
+            self.pieces = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class Pipeline:
+    def __init__(self, workers=DEFAULT_WORKERS, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.num_queued = 0
+        self.error = None
+        self.cond = threading.Condition()
+        self.jobs = queue.Queue()
+        self.threads = []
+        for i in range(max(1, workers)):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            path, offset, pieces, length, member = job
+            size = sum(len(data) for data in pieces)
+            try:
+                if self.error is None:
+                    write_piece(path, offset, pieces, length, member.report)
+            except BaseException as e:
+                # the frames of the traceback still hold the buffers, which
+                # may be views of a mapping the reader is about to close
+                traceback.clear_frames(e.__traceback__)
+                with self.cond:
+                    if self.error is None:
+                        self.error = e
+            # let go of the buffers before the reader is told there is room
+            job = pieces = None
+            with self.cond:
+                self.in_flight -= size
+                self.num_queued -= 1
+                member.num_pieces -= 1
+                written = member.closed and member.num_pieces == 0
+                self.cond.notify_all()
+            if written:
+                member.timer.done()
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def put(self, job, size):
+        with self.cond:
+            # a single piece larger than the cap is let through on its own
+            while self.in_flight and self.in_flight + size > self.max_in_flight and self.error is None:
+                self.cond.wait()
+            self.check()
+            self.in_flight += size
+            self.num_queued += 1
+            member = job[4]
+            member.num_pieces += 1
+            if job[3] is not None:
+                member.closed = True
+        self.jobs.put(job)
+
+    def open(self, path, size=None, timer=metrics.null_timer):
+        return MemberWriter(self, path, timer)
+
+    def submit(self, path, data, timer=metrics.null_timer):
+        self.put((path, 0, [data], len(data), PendingMember(timer)), len(data))
+
+    def wait(self):
+        # until everything handed over so far is written
+        with self.cond:
+            # on error too, as the queued jobs still hold their buffers
+            while self.num_queued:
+                self.cond.wait()
+            self.check()
+
+    def close(self):
+        if not self.threads:
+            return
+        for thread in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            # already failing; do not mask that with a write error
+            try:
+                self.close()
+            except Exception:
+                pass
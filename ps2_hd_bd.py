@@ -0,0 +1,322 @@
+# PS2 sound bank (.HD/.BD) sample extractor
+#
+# The .HD is a set of chunks, each starting with "SCEI" and its type as
+# little-endian words ("IECS" "sreV", "IECS" "daeH", ...). The VAG info chunk
+# gives the offset and sample rate of every sample in the .BD; the program,
+# sample set and sample chunks map key and velocity ranges to them.
+#
+# The samples are cut from the .BD in one pass in offset order, as views of
+# the mapped file, each up to its end frame, and written as .VAG files. An
+# index of the bank (.json) keeps where each sample lives in the .BD, so
+# single samples can be read later without scanning the bank again.
+
+import os
+import sys
+import json
+import mmap
+import struct
+import collections
+
+from binary_reader import get_u32_le
+from container import Container
+import metrics
+import vag
+
+CHUNK_ID = b"IECS"
+
+VERSION_CHUNK = b"sreV"
+HEADER_CHUNK = b"daeH"
+PROGRAM_CHUNK = b"gorP"
+SAMPLE_SET_CHUNK = b"tesS"
+SAMPLE_CHUNK = b"lpmS"
+VAG_INFO_CHUNK = b"igaV"
+
+# chunk size, .HD size, .BD size, program, sample set, sample and VAG info
+# chunk offsets
+HD_HEADER = struct.Struct("<7I")
+
+# offset in the .BD, sample rate, attribute
+VAG_INFO = struct.Struct("<IHB")
+
+VAG_ATTR_LOOP = 0x01
+
+# VAG index, velocity low/cross-fade/high, base note, detune, pan, volume
+SAMPLE_PARAM = struct.Struct("<HBBB6xBbb2xB")
+
+# velocity curve, velocity low/high, number of samples (then their indexes)
+SAMPLE_SET_PARAM = struct.Struct("<4B")
+
+# split block offset, number and size of split blocks, volume, pan,
+# transpose, detune
+PROGRAM_PARAM = struct.Struct("<IBBBbbb")
+
+# sample set index, key low/cross-fade/high
+SPLIT_BLOCK = struct.Struct("<HBBB")
+
+UNUSED = 0xFFFFFFFF
+
+# id, version, data size, sample rate, name
+VAG_HEADER = struct.Struct(">4sI4xII12x16s")
+
+VagInfo = collections.namedtuple("VagInfo", "index offset rate loop")
+
+BankSample = collections.namedtuple("BankSample", "index offset size rate loop loop_start loop_end")
+
+USAGE = """Usage: %s [-l] [-w] <HD> [<BD>]
+
+  -l  only list the samples of the bank
+  -w  also decode every sample to <bank>_NNNN.wav (see vag.py)
+
+The samples of the .BD (by default, the one next to the .HD) are written to
+<bank>_NNNN.vag, and an index of the bank to <bank>.json."""
+
+def check_chunk(hd, offset, chunk_type):
+    if offset + 0x0C > len(hd) or hd[offset:offset+8] != CHUNK_ID + chunk_type:
+        raise ValueError("No %s chunk at 0x%X" % (chunk_type[::-1].decode("ASCII"), offset))
+
+def read_header(hd):
+    check_chunk(hd, 0, VERSION_CHUNK)
+    offset = get_u32_le(hd, 0x08)
+    check_chunk(hd, offset, HEADER_CHUNK)
+    return HD_HEADER.unpack_from(hd, offset + 0x08)
+
+def read_chunk_entries(hd, offset, chunk_type):
+    # (index, absolute offset) of every used entry of a chunk
+    if offset == UNUSED:
+        return []
+    check_chunk(hd, offset, chunk_type)
+    max_index = get_u32_le(hd, offset + 0x0C)
+    if offset + 0x10 + (max_index + 1) * 4 > len(hd):
+        raise ValueError("Truncated %s chunk" % chunk_type[::-1].decode("ASCII"))
+    entries = struct.unpack_from("<%dI" % (max_index + 1), hd, offset + 0x10)
+    return [(index, offset + entry) for index, entry in enumerate(entries) if entry != UNUSED]
+
+def read_vag_infos(hd, offset):
+    infos = []
+    for index, entry in read_chunk_entries(hd, offset, VAG_INFO_CHUNK):
+        vag_offset, rate, attr = VAG_INFO.unpack_from(hd, entry)
+        infos.append(VagInfo(index, vag_offset, rate, bool(attr & VAG_ATTR_LOOP)))
+    return infos
+
+def read_samples(hd, offset):
+    samples = {}
+    for index, entry in read_chunk_entries(hd, offset, SAMPLE_CHUNK):
+        vag_index, vel_low, vel_fade, vel_high, base_note, detune, pan, volume = SAMPLE_PARAM.unpack_from(hd, entry)
+        samples[index] = {
+            "vag": vag_index,
+            "velocity_low": vel_low,
+            "velocity_high": vel_high,
+            "base_note": base_note,
+            "detune": detune,
+            "pan": pan,
+            "volume": volume,
+        }
+    return samples
+
+def read_sample_sets(hd, offset):
+    sample_sets = {}
+    for index, entry in read_chunk_entries(hd, offset, SAMPLE_SET_CHUNK):
+        num_samples = SAMPLE_SET_PARAM.unpack_from(hd, entry)[3]
+        sample_sets[index] = list(struct.unpack_from("<%dH" % num_samples, hd, entry + SAMPLE_SET_PARAM.size))
+    return sample_sets
+
+def read_programs(hd, offset, sample_sets, samples):
+    # every program with its key splits, resolved down to the samples
+    programs = []
+    for index, entry in read_chunk_entries(hd, offset, PROGRAM_CHUNK):
+        split_offset, num_splits, split_size, volume, pan, transpose, detune = PROGRAM_PARAM.unpack_from(hd, entry)
+        splits = []
+        for i in range(num_splits):
+            sample_set, key_low, key_fade, key_high = SPLIT_BLOCK.unpack_from(hd, entry + split_offset + i * split_size)
+            splits.append({
+                "key_low": key_low,
+                "key_high": key_high,
+                "sample_set": sample_set,
+                "samples": [dict(samples[sample], sample=sample) for sample in sample_sets.get(sample_set, ()) if sample in samples],
+            })
+        programs.append({
+            "index": index,
+            "volume": volume,
+            "pan": pan,
+            "transpose": transpose,
+            "detune": detune,
+            "splits": splits,
+        })
+    return programs
+
+def locate_samples(infos, bd):
+    # each sample runs at most up to the next one (or the end of the .BD),
+    # and stops at its end frame; only samples the .HD says loop get loop
+    # points, whatever their frames say
+    offsets = sorted(set(info.offset for info in infos if info.offset < len(bd))) + [len(bd)]
+    next_offset = dict(zip(offsets, offsets[1:]))
+    samples = []
+    for info in sorted(infos, key=lambda info: (info.offset, info.index)):
+        if info.offset not in next_offset:
+            print("WARNING: sample %d is past the end of the BD" % info.index)
+            continue
+        sample = vag.scan_sample(bd, info.offset, next_offset[info.offset] - info.offset)
+        if info.loop:
+            loop_start, loop_end = sample.loop_start, sample.loop_end
+        else:
+            loop_start = loop_end = None
+        samples.append(BankSample(info.index, sample.offset, sample.size, info.rate, info.loop, loop_start, loop_end))
+    return samples
+
+def get_bd_path(hd_path):
+    stem = os.path.splitext(hd_path)[0]
+    for ext in (".BD", ".bd"):
+        if os.path.isfile(stem + ext):
+            return stem + ext
+    return stem + ".BD"
+
+def make_vag_header(size, rate, name):
+    return VAG_HEADER.pack(vag.VAG_ID, 0x20, size, rate, name.encode("ASCII", "replace")[:16])
+
+def sample_path(bd_stem, index, ext):
+    return "%s_%04d.%s" % (bd_stem, index, ext)
+
+def make_index(hd_path, bd_path, bd_size, samples, programs):
+    bd_stem = os.path.splitext(bd_path)[0]
+    return {
+        "hd": os.path.basename(hd_path),
+        "bd": os.path.basename(bd_path),
+        "bd_size": bd_size,
+        "samples": [{
+            "index": sample.index,
+            "offset": sample.offset,
+            "size": sample.size,
+            "rate": sample.rate,
+            "loop": sample.loop,
+            "loop_start": sample.loop_start,
+            "loop_end": sample.loop_end,
+            "file": os.path.basename(sample_path(bd_stem, sample.index, "vag")),
+        } for sample in sorted(samples)],
+        "programs": programs,
+    }
+
+class Bank:
+    def __init__(self, hd_path, bd_path=None):
+        self.hd_path = hd_path
+        self.bd_path = bd_path or get_bd_path(hd_path)
+        self.map = None
+
+        with metrics.open_file(hd_path, "rb") as f:
+            hd = f.read()
+
+        with metrics.phase("hd"):
+            (_, _, _, program_offset, sample_set_offset, sample_offset, vag_info_offset) = read_header(hd)
+            self.infos = read_vag_infos(hd, vag_info_offset)
+            self.programs = read_programs(hd, program_offset, read_sample_sets(hd, sample_set_offset), read_samples(hd, sample_offset))
+
+        with metrics.open_file(self.bd_path, "rb") as f:
+            if os.fstat(f.fileno()).st_size:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.bd = memoryview(self.map)
+            else:
+                self.bd = memoryview(b"")
+
+        with metrics.phase("scan"):
+            self.samples = locate_samples(self.infos, self.bd)
+
+    def close(self):
+        if self.map is not None:
+            self.bd.release()
+            self.map.close()
+            self.map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_output(path, size, output=None):
+    if output is None:
+        return metrics.open_file(path, "wb")
+    return output.open(path, size)
+
+def extract_bank(hd_path, bd_path=None, wav=False, output=None):
+    with Bank(hd_path, bd_path) as bank:
+        bd_stem = os.path.splitext(bank.bd_path)[0]
+        name = os.path.basename(bd_stem)
+
+        for sample in bank.samples:
+            path = sample_path(bd_stem, sample.index, "vag")
+            header = make_vag_header(sample.size, sample.rate, "%s_%04d" % (name, sample.index))
+            with metrics.member(path, len(header) + sample.size), open_output(path, len(header) + sample.size, output) as f:
+                f.write(header)
+                f.write(bank.bd[sample.offset:sample.offset+sample.size])
+
+        if wav:
+            with metrics.phase("decode"):
+                pcms = vag.decode_samples(bank.bd, bank.samples)
+            for sample, pcm in zip(bank.samples, pcms):
+                path = sample_path(bd_stem, sample.index, "wav")
+                data = vag.make_wav(pcm, sample.rate or vag.DEFAULT_SAMPLE_RATE, sample.loop_start, sample.loop_end)
+                with metrics.member(path, len(data)), open_output(path, len(data), output) as f:
+                    f.write(data)
+
+        index = json.dumps(make_index(bank.hd_path, bank.bd_path, len(bank.bd), bank.samples, bank.programs), indent=2).encode("ASCII")
+        with open_output("%s.json" % bd_stem, len(index), output) as f:
+            f.write(index)
+
+        return bank.samples
+
+def list_bank(hd_path, bd_path=None):
+    with Bank(hd_path, bd_path) as bank:
+        for sample in sorted(bank.samples):
+            loop = "loop %d-%d" % (sample.loop_start, sample.loop_end) if sample.loop_start is not None else ""
+            print("%4d %08X %08X %5d  %s" % (sample.index, sample.offset, sample.size, sample.rate, loop))
+
+def open_container(hd_path, bd_path=None):
+    container = Container()
+    try:
+        with Bank(hd_path, bd_path) as bank:
+            fd = container.add_source(bank.bd_path)
+            bd_stem = os.path.splitext(os.path.basename(bank.bd_path))[0]
+            for sample in bank.samples:
+                header = make_vag_header(sample.size, sample.rate, "%s_%04d" % (bd_stem, sample.index))
+                container.add_member(os.path.basename(sample_path(bd_stem, sample.index, "vag")),
+                                     [header, (fd, sample.offset, sample.size)])
+    except:
+        container.close()
+        raise
+    return container
+
+def main(argc=len(sys.argv), argv=sys.argv):
+    args = argv[1:argc]
+    list_only = False
+    wav = False
+
+    while args and args[0] in ("-l", "-w"):
+        if args.pop(0) == "-l":
+            list_only = True
+        else:
+            wav = True
+
+    if not 1 <= len(args) <= 2:
+        print(USAGE % argv[0])
+        return 1
+
+    hd_path = os.path.realpath(args[0])
+    bd_path = os.path.realpath(args[1]) if len(args) == 2 else None
+
+    if not os.path.isfile(hd_path) or not os.path.isfile(bd_path or get_bd_path(hd_path)):
+        print("ERROR: Invalid file path")
+        return 1
+
+    try:
+        if list_only:
+            list_bank(hd_path, bd_path)
+        else:
+            samples = extract_bank(hd_path, bd_path, wav)
+            print("Extracted %d samples" % len(samples))
+    except (ValueError, struct.error) as e:
+        print("ERROR: %s" % e)
+        return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
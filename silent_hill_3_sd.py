@@ -2,25 +2,240 @@
 
 import os
 import sys
+import json
 import struct
+import hashlib
 
-def read_u32_le(f):
-    return struct.unpack("<I", f.read(4))[0]
+from binary_reader import read_struct
+from container import Container, copy_segment
+import metrics
 
-def write_u32_le(f, x):
-    f.write(struct.pack("<I", x))
+SECTOR_SIZE = 2048
 
-def extract(fin, dst, sector, size):
-    with open(dst, "wb") as fout:
-        fin.seek(sector * 2048)
-        fout.write(fin.read(size))
+# tdsect, tdsize, hdsect, hdsize, bdsect, bdsize
+SD_HEADER = struct.Struct("<6I")
 
-def insert(fout, src):
-    size = os.path.getsize(src)
-    outbuf = bytearray(size + (2048 - (size % 2048)) if size % 2048 else size)
-    with open(src, "rb") as fin:
-        outbuf[:size] = fin.read(size)
-    fout.write(outbuf)
+SD_ID = b"TYOSD v-1.01\x03\x00\x00\x00"
+
+SECTIONS = ("TD", "HD", "BD")
+
+MANIFEST_SUFFIX = ".manifest"
+
+USAGE = """Usage: %s [e <sd.bin> | b <dir> [<sd.bin>] | u <dir> [<sd.bin>]]
+
+  e  extract sd.TD, sd.HD and sd.BD next to sd.bin
+  b  build sd.bin from the sd.TD, sd.HD and sd.BD in <dir>
+     (written to <dir>/sd.bin unless another path is given)
+  u  like b, but only rewrite the sections that changed since the last
+     u run, in place if they still fit their sectors (see sd.bin.manifest)
+
+Without arguments, the mode and paths are prompted for."""
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+def open_output(dst, size, output=None):
+    if output is None:
+        return metrics.open_file(dst, "wb")
+    return output.open(dst, size)
+
+def extract(fin, dst, sector, size, output=None):
+    with metrics.member(dst, size), open_output(dst, size, output) as fout:
+        # archive members have no file descriptor of their own
+        copy_segment(fin.fileno(), sector * SECTOR_SIZE, size, fout.fileno() if hasattr(fout, "fileno") else fout)
+
+def insert(fout, src, digest=None):
+    # stream the file in, then pad it out to the next sector boundary
+    size = 0
+    with metrics.open_file(src, "rb") as fin:
+        while True:
+            buf = fin.read(COPY_CHUNK_SIZE)
+            if not buf:
+                break
+            fout.write(buf)
+            if digest is not None:
+                digest.update(buf)
+            size += len(buf)
+    if size % SECTOR_SIZE:
+        fout.write(bytes(SECTOR_SIZE - size % SECTOR_SIZE))
+    return size
+
+def read_header(fin):
+    fin.seek(0)
+    if fin.read(0x10) != SD_ID:
+        raise ValueError("Unexpected ID in main header of sd.bin")
+    return read_struct(fin, SD_HEADER)
+
+def write_header(fout, tdsect, tdsize, hdsect, hdsize, bdsect, bdsize):
+    fout.seek(0x10)
+    fout.write(SD_HEADER.pack(tdsect, tdsize, hdsect, hdsize, bdsect, bdsize))
+
+def extract_sd(bin_path, log=print, output=None):
+    sd_stem = os.path.splitext(bin_path)[0]
+
+    with metrics.open_file(bin_path, "rb") as bin:
+        with metrics.phase("header"):
+            tdsect, tdsize, hdsect, hdsize, bdsect, bdsize = read_header(bin)
+
+        extract(bin, "%s.TD" % sd_stem, tdsect, tdsize, output)
+        log("Extracted: sd.TD")
+
+        extract(bin, "%s.HD" % sd_stem, hdsect, hdsize, output)
+        log("Extracted: sd.HD")
+
+        extract(bin, "%s.BD" % sd_stem, bdsect, bdsize, output)
+        log("Extracted: sd.BD")
+
+def open_container(bin_path):
+    sd_stem = os.path.splitext(os.path.basename(bin_path))[0]
+
+    with metrics.open_file(bin_path, "rb") as bin:
+        tdsect, tdsize, hdsect, hdsize, bdsect, bdsize = read_header(bin)
+
+    container = Container()
+    fd = container.add_source(bin_path)
+    container.add_range("%s.TD" % sd_stem, fd, tdsect * SECTOR_SIZE, tdsize)
+    container.add_range("%s.HD" % sd_stem, fd, hdsect * SECTOR_SIZE, hdsize)
+    container.add_range("%s.BD" % sd_stem, fd, bdsect * SECTOR_SIZE, bdsize)
+    return container
+
+def build_sd(bin_path, td_path, hd_path, bd_path, digests=(None, None, None)):
+    with metrics.open_file(bin_path, "wb") as bin:
+        bin.write(SD_ID)
+        bin.write(bytes(SECTOR_SIZE - len(SD_ID)))
+
+        tdsect = bin.tell() // SECTOR_SIZE
+        tdsize = insert(bin, td_path, digests[0])
+
+        hdsect = bin.tell() // SECTOR_SIZE
+        hdsize = insert(bin, hd_path, digests[1])
+
+        bdsect = bin.tell() // SECTOR_SIZE
+        bdsize = insert(bin, bd_path, digests[2])
+
+        write_header(bin, tdsect, tdsize, hdsect, hdsize, bdsect, bdsize)
+
+def padded_size(size):
+    return (size + SECTOR_SIZE - 1) // SECTOR_SIZE * SECTOR_SIZE
+
+def hash_file(path):
+    digest = hashlib.sha1()
+    with metrics.open_file(path, "rb") as f:
+        while True:
+            buf = f.read(COPY_CHUNK_SIZE)
+            if not buf:
+                break
+            digest.update(buf)
+    return digest.hexdigest()
+
+def load_manifest(path):
+    try:
+        with open(path, "r") as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if not isinstance(manifest, dict) or not all(name in manifest for name in SECTIONS):
+        return None
+    return manifest
+
+def save_manifest(path, manifest):
+    with open(path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+def write_zeros(fout, count):
+    while count > 0:
+        n = min(count, COPY_CHUNK_SIZE)
+        fout.write(bytes(n))
+        count -= n
+
+def full_update(bin_path, src_paths, log):
+    digests = [hashlib.sha1() for name in SECTIONS]
+    stats = [os.stat(src_paths[name]) for name in SECTIONS]
+    build_sd(bin_path, src_paths["TD"], src_paths["HD"], src_paths["BD"], digests)
+    manifest = {}
+    for name, st, digest in zip(SECTIONS, stats, digests):
+        manifest[name] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha1": digest.hexdigest()}
+    save_manifest(bin_path + MANIFEST_SUFFIX, manifest)
+    log("Rebuilt: sd.bin")
+
+def update_sd(bin_path, td_path, hd_path, bd_path, log=print):
+    src_paths = dict(zip(SECTIONS, (td_path, hd_path, bd_path)))
+    manifest_path = bin_path + MANIFEST_SUFFIX
+    manifest = load_manifest(manifest_path)
+
+    header = None
+    if manifest is not None and os.path.isfile(bin_path):
+        with metrics.open_file(bin_path, "rb") as bin:
+            try:
+                header = read_header(bin)
+            except (ValueError, struct.error):
+                pass
+
+    # only trust the manifest if it still describes this sd.bin
+    if header is None or any(manifest[name]["size"] != header[i*2+1] for i, name in enumerate(SECTIONS)):
+        full_update(bin_path, src_paths, log)
+        return
+
+    sects = dict(zip(SECTIONS, header[0::2]))
+    sizes = dict(zip(SECTIONS, header[1::2]))
+
+    changed = []
+    dirty = False
+
+    for name in SECTIONS:
+        entry = manifest[name]
+        st = os.stat(src_paths[name])
+        if st.st_size == entry["size"] and st.st_mtime_ns == entry["mtime_ns"]:
+            continue
+        sha1 = hash_file(src_paths[name])
+        dirty = True
+        if st.st_size == entry["size"] and sha1 == entry["sha1"]:
+            entry["mtime_ns"] = st.st_mtime_ns
+            continue
+        changed.append(name)
+        manifest[name] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha1": sha1}
+
+    for name in changed:
+        # a section may grow into its padding, up to where the next one starts
+        following = [sects[other] for other in SECTIONS if sects[other] > sects[name]]
+        if following and padded_size(manifest[name]["size"]) > (min(following) - sects[name]) * SECTOR_SIZE:
+            log("No room for sd.%s in place" % name)
+            full_update(bin_path, src_paths, log)
+            return
+
+    if changed:
+        with metrics.open_file(bin_path, "r+b") as bin:
+            last = max(SECTIONS, key=lambda name: sects[name])
+            for name in changed:
+                start = sects[name] * SECTOR_SIZE
+                old_end = start + padded_size(sizes[name])
+                bin.seek(start)
+                sizes[name] = insert(bin, src_paths[name])
+                if name == last:
+                    bin.truncate(bin.tell())
+                elif bin.tell() < old_end:
+                    # clear what is left of the previous, larger contents
+                    write_zeros(bin, old_end - bin.tell())
+                log("Updated: sd.%s" % name)
+            write_header(bin, sects["TD"], sizes["TD"], sects["HD"], sizes["HD"], sects["BD"], sizes["BD"])
+    else:
+        log("sd.bin is up to date")
+
+    if dirty:
+        save_manifest(manifest_path, manifest)
+
+def get_section_paths(basedir):
+    paths = []
+    for name in ("sd.TD", "sd.HD", "sd.BD"):
+        path = os.path.join(basedir, name)
+        if not os.access(path, os.R_OK):
+            raise IOError("Cannot open %s" % name)
+        paths.append(path)
+    return paths
+
+def can_write(path):
+    if os.path.exists(path):
+        return os.access(path, os.W_OK)
+    return os.access(os.path.dirname(path) or ".", os.W_OK)
 
 def get_file_arg(message, real=True):
     x = ''
@@ -42,84 +257,50 @@ def get_lit_arg(valid_list, message, lowercase=True):
             x = x.lower()
     return x
 
-mode = get_lit_arg(['b','e'], "Enter 'e' to extract, 'b' to build: ")
-
-if mode == 'e':
-    bin_path = get_file_arg("Enter path to sd.bin: ")
-    if not os.access(bin_path, os.R_OK):
-        input("Cannot open sd.bin")
-        sys.exit(1)
-
-    sd_stem = os.path.splitext(bin_path)[0]
-
-    with open(bin_path, "rb") as bin:
-        if bin.read(0x10) != b"TYOSD v-1.01\x03\x00\x00\x00":
-            input("Unexpected ID in main header of sd.bin")
-            sys.exit(1)
-
-        tdsect = read_u32_le(bin)
-        tdsize = read_u32_le(bin)
-        hdsect = read_u32_le(bin)
-        hdsize = read_u32_le(bin)
-        bdsect = read_u32_le(bin)
-        bdsize = read_u32_le(bin)
-
-        extract(bin, "%s.TD" % sd_stem, tdsect, tdsize)
-        print("Extracted: sd.TD")
-
-        extract(bin, "%s.HD" % sd_stem, hdsect, hdsize)
-        print("Extracted: sd.HD")
-
-        extract(bin, "%s.BD" % sd_stem, bdsect, bdsize)
-        print("Extracted: sd.BD")
-
-elif mode == 'b':
-    basedir = get_dir_arg("Enter path to directory containing sd.TD, sd.HD and sd.BD: ")
-
-    td_path = os.path.join(basedir, "sd.TD")
-    if not os.access(td_path, os.R_OK):
-        input("Cannot open sd.TD")
-        sys.exit(1)
-
-    hd_path = os.path.join(basedir, "sd.HD")
-    if not os.access(hd_path, os.R_OK):
-        input("Cannot open sd.HD")
-        sys.exit(1)
-
-    bd_path = os.path.join(basedir, "sd.BD")
-    if not os.access(bd_path, os.R_OK):
-        input("Cannot open sd.BD")
-        sys.exit(1)
-
-    bin_path = os.path.join(basedir, "sd.bin")
-    if not os.access(bin_path, os.W_OK):
-        input("Cannot create/open sd.bin")
-        sys.exit(1)
-
-    with open(bin_path, "wb") as bin:
-        bin.write(b"TYOSD v-1.01\x03\x00\x00\x00")
-
-        bin.seek(2048)
+def run(mode, path, bin_path=None):
+    if mode == 'e':
+        if not os.access(path, os.R_OK):
+            raise IOError("Cannot open sd.bin")
+        extract_sd(path)
 
-        tdsect = bin.tell() // 2048
-        tdsize = os.path.getsize(td_path)
-        insert(bin, td_path)
+    elif mode in ('b', 'u'):
+        td_path, hd_path, bd_path = get_section_paths(path)
+        if bin_path is None:
+            bin_path = os.path.join(path, "sd.bin")
+        if not can_write(bin_path):
+            raise IOError("Cannot create/open sd.bin")
+        if mode == 'u':
+            update_sd(bin_path, td_path, hd_path, bd_path)
+        else:
+            build_sd(bin_path, td_path, hd_path, bd_path)
 
-        hdsect = bin.tell() // 2048
-        hdsize = os.path.getsize(hd_path)
-        insert(bin, hd_path)
+def main(argc=len(sys.argv), argv=sys.argv):
+    if argc == 1:
+        # interactive mode, for when the script is run by double-clicking
+        mode = get_lit_arg(['b','e'], "Enter 'e' to extract, 'b' to build: ")
+        if mode == 'e':
+            path = get_file_arg("Enter path to sd.bin: ")
+        else:
+            path = get_dir_arg("Enter path to directory containing sd.TD, sd.HD and sd.BD: ")
+        try:
+            run(mode, path)
+        except (IOError, ValueError) as e:
+            input(str(e))
+            return 1
+        input("All done.")
+        return 0
 
-        bdsect = bin.tell() // 2048
-        bdsize = os.path.getsize(bd_path)
-        insert(bin, bd_path)
+    if argc not in (3, 4) or argv[1] not in ('e', 'b', 'u') or (argc == 4 and argv[1] == 'e'):
+        print(USAGE % argv[0])
+        return 1
 
-        bin.seek(0x10)
+    try:
+        run(argv[1], os.path.realpath(argv[2]), os.path.realpath(argv[3]) if argc == 4 else None)
+    except (IOError, ValueError) as e:
+        print("ERROR: %s" % e)
+        return 1
 
-        write_u32_le(bin, tdsect)
-        write_u32_le(bin, tdsize)
-        write_u32_le(bin, hdsect)
-        write_u32_le(bin, hdsize)
-        write_u32_le(bin, bdsect)
-        write_u32_le(bin, bdsize)
+    return 0
 
-input("All done.")
+if __name__ == "__main__":
+    sys.exit(main())
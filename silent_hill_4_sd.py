@@ -4,13 +4,53 @@ import os
 import sys
 import struct
 
-def read_u32_le(f):
-    return struct.unpack("<I", f.read(4))[0]
+from binary_reader import read_struct
+from container import Container, copy_segment
+import metrics
 
-def extract(fin, dst, sector, size):
-    with open(dst, "wb") as fout:
-        fin.seek(sector * 2048)
-        fout.write(fin.read(size))
+# hdsect, hdsize, bdsect, bdsize, tdsect, tdsize
+SD_HEADER = struct.Struct("<6I")
+
+def open_output(dst, size, output=None):
+    if output is None:
+        return metrics.open_file(dst, "wb")
+    return output.open(dst, size)
+
+def extract(fin, dst, sector, size, output=None):
+    with metrics.member(dst, size), open_output(dst, size, output) as fout:
+        # archive members have no file descriptor of their own
+        copy_segment(fin.fileno(), sector * 2048, size, fout.fileno() if hasattr(fout, "fileno") else fout)
+
+def extract_sd(bin_path, log=print, output=None):
+    sd_stem = os.path.splitext(bin_path)[0]
+
+    with metrics.open_file(bin_path, "rb") as bin:
+        with metrics.phase("header"):
+            bin.seek(0x10)
+            hdsect, hdsize, bdsect, bdsize, tdsect, tdsize = read_struct(bin, SD_HEADER)
+
+        extract(bin, "%s.HD" % sd_stem, hdsect, hdsize, output)
+        log("Extracted: sd.HD")
+
+        extract(bin, "%s.BD" % sd_stem, bdsect, bdsize, output)
+        log("Extracted: sd.BD")
+
+        extract(bin, "%s.TD" % sd_stem, tdsect, tdsize, output)
+        log("Extracted: sd.TD")
+
+def open_container(bin_path):
+    sd_stem = os.path.splitext(os.path.basename(bin_path))[0]
+
+    with metrics.open_file(bin_path, "rb") as bin:
+        bin.seek(0x10)
+        hdsect, hdsize, bdsect, bdsize, tdsect, tdsize = read_struct(bin, SD_HEADER)
+
+    container = Container()
+    fd = container.add_source(bin_path)
+    container.add_range("%s.HD" % sd_stem, fd, hdsect * 2048, hdsize)
+    container.add_range("%s.BD" % sd_stem, fd, bdsect * 2048, bdsize)
+    container.add_range("%s.TD" % sd_stem, fd, tdsect * 2048, tdsize)
+    return container
 
 def main(argc=len(sys.argv), argv=sys.argv):
     if argc != 2:
@@ -23,26 +63,7 @@ def main(argc=len(sys.argv), argv=sys.argv):
         input("Cannot open sd.bin")
         sys.exit(1)
 
-    sd_stem = os.path.splitext(bin_path)[0]
-
-    with open(bin_path, "rb") as bin:
-        bin.seek(0x10)
-
-        hdsect = read_u32_le(bin)
-        hdsize = read_u32_le(bin)
-        bdsect = read_u32_le(bin)
-        bdsize = read_u32_le(bin)
-        tdsect = read_u32_le(bin)
-        tdsize = read_u32_le(bin)
-
-        extract(bin, "%s.HD" % sd_stem, hdsect, hdsize)
-        print("Extracted: sd.HD")
-
-        extract(bin, "%s.BD" % sd_stem, bdsect, bdsize)
-        print("Extracted: sd.BD")
-
-        extract(bin, "%s.TD" % sd_stem, tdsect, tdsize)
-        print("Extracted: sd.TD")
+    extract_sd(bin_path)
 
     input("All done.")
 
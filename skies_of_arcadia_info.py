@@ -3,37 +3,23 @@
 
 import os
 import sys
-import struct
 
-def get_u16_be(buf, off=0):
-    return struct.unpack(">H", buf[off:off+2])[0]
-
-def main(argc=len(sys.argv), argv=sys.argv):
-    if argc != 2:
-        print("Usage: %s <infofile>" % argv[0])
-        return 1
-
-    infopath = os.path.realpath(argv[1])
-
-    if not os.path.isfile(infopath):
-        print("File path is invalid!")
-        return 1
-
-    stem = os.path.splitext(infopath)[0]
-
-    with open(infopath, "rb") as info:
-        infobuf = info.read()
-
-    offset = 0
+from binary_reader import get_u16_be, get_u16_table_be
+from container import Container
+import metrics
 
+def get_chunks(infobuf, stem, info_size):
+    # (outpath, offset, size) of every chunk listed in the offset table
     offsets = []
 
     table_size = 4 * get_u16_be(infobuf, 0x00)
 
-    while offset < table_size and get_u16_be(infobuf, offset) != 0:
-        ckoff = 4 * get_u16_be(infobuf, offset)
-        offsets.append(ckoff)
-        offset += 2
+    for ckoff in get_u16_table_be(infobuf, min(table_size, len(infobuf)) // 2):
+        if ckoff == 0:
+            break
+        offsets.append(4 * ckoff)
+
+    chunks = []
 
     for idx in range( len(offsets) ):
         if idx <= 0:
@@ -53,10 +39,58 @@ def main(argc=len(sys.argv), argv=sys.argv):
         if idx < len(offsets) - 1:
             cksize = offsets[idx+1] - ckoff
         else:
-            cksize = len(infobuf) - ckoff
+            cksize = info_size - ckoff
+
+        chunks.append((outpath, ckoff, cksize))
+
+    return chunks
+
+def extract_info(infopath, output=None):
+    stem = os.path.splitext(infopath)[0]
+
+    with metrics.open_file(infopath, "rb") as info:
+        infobuf = info.read()
+
+    with metrics.phase("table"):
+        chunks = get_chunks(infobuf, stem, len(infobuf))
+
+    for outpath, ckoff, cksize in chunks:
+        with metrics.member(outpath, cksize):
+            if output is None:
+                with metrics.open_file(outpath, "wb") as outfile:
+                    outfile.write(infobuf[ckoff:ckoff+cksize])
+            else:
+                output.submit(outpath, infobuf[ckoff:ckoff+cksize])
+
+def open_container(infopath):
+    stem = os.path.splitext(os.path.basename(infopath))[0]
+
+    with metrics.open_file(infopath, "rb") as info:
+        info_size = os.fstat(info.fileno()).st_size
+        # the offset table is what the first entry points past
+        table = info.read(2)
+        # with no entries there is no rest of the table to read
+        if len(table) == 2 and get_u16_be(table, 0x00) > 0:
+            table += info.read(4 * get_u16_be(table, 0x00) - 2)
+
+    container = Container()
+    fd = container.add_source(infopath)
+    for name, ckoff, cksize in get_chunks(table, stem, info_size):
+        container.add_range(name, fd, ckoff, max(0, cksize))
+    return container
+
+def main(argc=len(sys.argv), argv=sys.argv):
+    if argc != 2:
+        print("Usage: %s <infofile>" % argv[0])
+        return 1
+
+    infopath = os.path.realpath(argv[1])
+
+    if not os.path.isfile(infopath):
+        print("File path is invalid!")
+        return 1
 
-        with open(outpath, "wb") as outfile:
-            outfile.write(infobuf[ckoff:ckoff+cksize])
+    extract_info(infopath)
 
     return 0
 
@@ -2,63 +2,349 @@
 
 import os
 import sys
+import json
+import shutil
 import struct
+import hashlib
+import tempfile
+import collections
 
-def get_u32_le(buf, off=0):
-    return struct.unpack("<I", buf[off:off+4])[0]
+from binary_reader import get_u32_le, iter_records
+from container import Container, pread
+from pipeline import Pipeline
+import metrics
 
-def main(argc=len(sys.argv), argv=sys.argv):
-    if argc != 2:
-        input("Usage: %s <trg.bin>" % argv[0])
-        return 1
+SECTOR_SIZE = 2048
 
-    bin_path = os.path.realpath(argv[1])
+# ranges closer than this are read through instead of seeking over the gap
+COALESCE_GAP = 0x40000
 
-    if not os.access(bin_path, os.R_OK):
-        input("Cannot open %s" % bin_path)
-        return 1
+# reads are issued in pieces of this size (a multiple of the sector size)
+READ_CHUNK_SIZE = 0x100000
 
-    bin_stem = os.path.splitext(bin_path)[0]
+# members that might duplicate an earlier one are held in memory up to this
+# size, so that a duplicate is never written out at all
+DEDUP_SPOOL_SIZE = 0x1000000
+
+USAGE = """Usage: %s [-d] [-j <workers>] <trg.bin>
+
+  -d  store identical members once, in <trg>_store
+  -j  extract this many members at once instead of reading trg.bin front
+      to back (not with -d)"""
+
+# sector, size
+TRG_RECORD = struct.Struct("<II")
+
+TrgEntry = collections.namedtuple("TrgEntry", "index group offset size")
+
+def get_ext(id):
+    if id == b"SdDt":
+        return "TD"
+    elif id == b"IECS":
+        return "HD"
+    else:
+        return "BD"
+
+def read_table(bin):
+    bin.seek(0x0C)
+
+    num_files = get_u32_le( bin.read(4) )
+    num_groups = num_files // 3
+
+    table = bin.read(num_groups * 3 * TRG_RECORD.size)
+
+    entries = []
+
+    for i, (sect, size) in enumerate(iter_records(TRG_RECORD, table, num_groups * 3)):
+        entries.append(TrgEntry(i, i // 3, sect * SECTOR_SIZE, size))
+
+    return entries
+
+def hash_file(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            buf = f.read(READ_CHUNK_SIZE)
+            if not buf:
+                break
+            digest.update(buf)
+    return digest.hexdigest()
+
+def remove_output(outpath):
+    # never write through an existing name, it may be a link into a store
+    if os.path.lexists(outpath):
+        os.remove(outpath)
+
+class DedupWriter:
+    def __init__(self, store, outpath, size, timer):
+        self.store = store
+        self.outpath = outpath
+        self.size = size
+        self.timer = timer
+        self.digest = hashlib.sha1()
+        # a payload with a size not seen before cannot be a duplicate
+        self.spooled = size in store.sizes
+        if self.spooled:
+            self.f = tempfile.SpooledTemporaryFile(max_size=DEDUP_SPOOL_SIZE, dir=store.store_dir)
+        else:
+            self.f = tempfile.NamedTemporaryFile(dir=store.store_dir, delete=False)
+        store.sizes.add(size)
+
+    def write(self, data):
+        self.digest.update(data)
+        self.f.write(data)
+
+    def close(self):
+        self.store.add(self)
+        self.timer.done()
+
+class DedupStore:
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        if not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+        # payloads stored by earlier runs; they are only named after their
+        # SHA-1, so each is hashed again before it is first linked to
+        self.known = set(name for name in os.listdir(store_dir) if len(name) == 40)
+        self.verified = set()
+        self.sizes = set(os.path.getsize(os.path.join(store_dir, name)) for name in self.known)
+        # temporary files are private; stored payloads get the usual mode
+        umask = os.umask(0)
+        os.umask(umask)
+        self.file_mode = 0o666 & ~umask
+        self.manifest = {}
+        self.num_deduped = 0
+        self.bytes_saved = 0
+
+    def open(self, outpath, size, timer=metrics.null_timer):
+        return DedupWriter(self, outpath, size, timer)
+
+    def add(self, writer):
+        name = writer.digest.hexdigest()
+        path = os.path.join(self.store_dir, name)
+
+        if name in self.known and name not in self.verified:
+            if hash_file(path) != name:
+                # changed through one of its links; stored again below
+                print("WARNING: %s does not match its name, replacing it" % path)
+                self.known.discard(name)
+                os.remove(path)
+            self.verified.add(name)
+
+        if name in self.known:
+            writer.f.close()
+            if not writer.spooled:
+                os.remove(writer.f.name)
+            self.num_deduped += 1
+            self.bytes_saved += writer.size
+        elif writer.spooled:
+            writer.f.seek(0)
+            with metrics.open_file(path, "wb") as fo:
+                shutil.copyfileobj(writer.f, fo)
+            writer.f.close()
+            self.known.add(name)
+            self.verified.add(name)
+        else:
+            writer.f.close()
+            os.chmod(writer.f.name, self.file_mode)
+            os.replace(writer.f.name, path)
+            self.known.add(name)
+            self.verified.add(name)
 
-    with open(bin_path, "rb") as bin:
+        self.link(path, writer.outpath, name)
 
-        bin.seek(0x0C)
+    def link(self, path, outpath, name):
+        entry = {"sha1": name, "linked": True}
+        remove_output(outpath)
+        try:
+            os.link(path, outpath)
+        except (OSError, AttributeError):
+            # no hard links here; the manifest says where the data is
+            entry["linked"] = False
+        self.manifest[os.path.basename(outpath)] = entry
 
-        num_files = get_u32_le( bin.read(4) )
-        num_groups = num_files // 3
+    def save_manifest(self):
+        with open(os.path.join(self.store_dir, "manifest.json"), "w") as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
 
-        table = bin.read(num_files * 8)
-        tableoff = 0
+def get_outpaths(bin, entries, bin_stem):
+    # the output path of every entry, by index; the member type is all that
+    # is read from the data itself, in disc order
+    outpaths = [None] * len(entries)
+    for entry in sorted(entries, key=lambda entry: (entry.offset, entry.index)):
+        bin.seek(entry.offset)
+        outpaths[entry.index] = "%s_%04d.%s" % (bin_stem, entry.group, get_ext(bin.read(4)))
+    return outpaths
 
-        for groupnum in range(num_groups):
+def plan_reads(entries, outpaths):
+    # entries of a group may get the same name (two with no known id are both
+    # BD); written in table order the last one wins, so only that one is kept
+    last = {}
+    for entry in entries:
+        last[outpaths[entry.index]] = entry.index
+    entries = [entry for entry in entries if last[outpaths[entry.index]] == entry.index]
 
-            for i in range(3):
+    # sort by position on disc and merge neighbouring entries into runs that
+    # can each be read with one seek
+    runs = []
 
-                sect = get_u32_le(table, tableoff+0x00)
-                size = get_u32_le(table, tableoff+0x04)
+    for entry in sorted(entries, key=lambda entry: (entry.offset, entry.index)):
+        end = entry.offset + entry.size
+        if runs and entry.offset - runs[-1][1] <= COALESCE_GAP:
+            run = runs[-1]
+            run[1] = max(run[1], end)
+            run[2].append(entry)
+        else:
+            runs.append([entry.offset, end, [entry]])
 
-                bin.seek(sect * 2048)
+    return runs
 
-                id = bin.read(4)
+def extract_run(bin, run, outpaths, open_output):
+    # open_output(path, size, timer) returns a file-like writer that is done
+    # with the timer once the member is written, which may be after close()
+    start, end, entries = run
 
-                if id == b"SdDt":
-                    ext = "TD"
-                elif id == b"IECS":
-                    ext = "HD"
+    pending = collections.deque(entries)
+    active = []
+
+    bin.seek(start)
+    pos = start
+
+    try:
+        while pos < end and (pending or active):
+            buf = bin.read(min(READ_CHUNK_SIZE, end - pos))
+            if not buf:
+                break
+            view = memoryview(buf)
+            buf_end = pos + len(buf)
+
+            while pending and pending[0].offset < buf_end:
+                entry = pending.popleft()
+                outpath = outpaths[entry.index]
+                fo = open_output(outpath, entry.size, metrics.member(outpath, entry.size))
+                active.append((entry, outpath, fo))
+
+            still_active = []
+
+            for i, (entry, outpath, fo) in enumerate(active):
+                entry_end = entry.offset + entry.size
+                fo.write(view[max(entry.offset, pos)-pos:min(entry_end, buf_end)-pos])
+                if entry_end <= buf_end:
+                    # off the list before closing, a failed close is not retried
+                    active[i] = None
+                    fo.close()
+                    print("Extracted: %s" % outpath)
                 else:
-                    ext = "BD"
+                    still_active.append((entry, outpath, fo))
+
+            active = still_active
+            pos = buf_end
+    except:
+        # a write error from the pipeline; do not leave the other outputs open
+        for member in active:
+            if member is not None:
+                try:
+                    member[2].close()
+                except Exception:
+                    pass
+        raise
+
+    # the file ended early; keep what was read, like a short read would
+    for entry, outpath, fo in active:
+        fo.close()
+        print("Extracted: %s" % outpath)
+
+    # entries no read got to (empty ones at the end of the run, or ones past
+    # the end of the file) still get their output, with nothing in it
+    for entry in pending:
+        outpath = outpaths[entry.index]
+        open_output(outpath, entry.size, metrics.member(outpath, entry.size)).close()
+        print("Extracted: %s" % outpath)
+
+def extract_parallel(bin_path, workers):
+    # member by member, several at once, for storage that serves many small
+    # reads in parallel better than the long runs of extract_trg
+    with open_container(bin_path) as container:
+        outdir = os.path.dirname(bin_path)
+        for name in container.names():
+            remove_output(os.path.join(outdir, name))
+        for outpath in container.extract(outdir, workers=workers):
+            print("Extracted: %s" % outpath)
+
+def extract_trg(bin_path, dedup=False, workers=1, output=None):
+    bin_stem = os.path.splitext(bin_path)[0]
+
+    if workers > 1 and not dedup and output is None:
+        return extract_parallel(bin_path, workers)
+
+    with metrics.open_file(bin_path, "rb") as bin:
 
-                outpath = "%s_%04d.%s" % (bin_stem, groupnum, ext)
+        with metrics.phase("table"):
+            entries = read_table(bin)
 
-                with open(outpath, "wb") as fo:
+        with metrics.phase("plan"):
+            outpaths = get_outpaths(bin, entries, bin_stem)
+            runs = plan_reads(entries, outpaths)
 
-                    fo.write( id + bin.read(size - 4) )
+        if output is not None:
+            for run in runs:
+                extract_run(bin, run, outpaths, output.open)
+        elif dedup:
+            store = DedupStore("%s_store" % bin_stem)
+            for run in runs:
+                extract_run(bin, run, outpaths, store.open)
+        else:
+            # members are written by other threads while the next run is read
+            with Pipeline() as pipeline:
+                def open_output(outpath, size, timer):
+                    remove_output(outpath)
+                    return pipeline.open(outpath, size, timer)
+                for run in runs:
+                    extract_run(bin, run, outpaths, open_output)
 
-                print("Extracted: %s" % outpath)
+    if dedup and output is None:
+        store.save_manifest()
+        print("Deduplicated %d members, saved %d bytes" % (store.num_deduped, store.bytes_saved))
+
+def open_container(bin_path):
+    bin_stem = os.path.splitext(os.path.basename(bin_path))[0]
+
+    with metrics.open_file(bin_path, "rb") as bin:
+        entries = read_table(bin)
+
+    container = Container()
+    fd = container.add_source(bin_path)
+    for entry in entries:
+        # the member type is all that is read from the data itself
+        ext = get_ext(pread(fd, 4, entry.offset))
+        container.add_range("%s_%04d.%s" % (bin_stem, entry.group, ext), fd, entry.offset, entry.size)
+    return container
+
+def main(argc=len(sys.argv), argv=sys.argv):
+    args = argv[1:argc]
+    dedup = False
+    workers = 1
+
+    while len(args) > 1 and args[0] in ("-d", "-j"):
+        opt = args.pop(0)
+        if opt == "-d":
+            dedup = True
+        else:
+            workers = max(1, int(args.pop(0)))
+
+    if len(args) != 1:
+        input(USAGE % argv[0])
+        return 1
+
+    bin_path = os.path.realpath(args[0])
+
+    if not os.access(bin_path, os.R_OK):
+        input("Cannot open %s" % bin_path)
+        return 1
 
-                tableoff += 8
+    extract_trg(bin_path, dedup, workers)
 
     input("All done.")
 
 if __name__=="__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,329 @@
+# Sony PS ADPCM (VAG) to WAV decoder
+#
+# Sample data is made of 16-byte frames: a shift/filter byte, a flags byte
+# and 28 4-bit samples. Every sample is the scaled nibble plus a prediction
+# from the two samples before it, so a frame depends on the end of the
+# previous one, except for filter 0 frames, which predict nothing.
+#
+# With NumPy, the frames of a whole bank are unpacked and scaled in one go,
+# filter 0 frames are done then and there, and the filter runs over all the
+# remaining runs of dependent frames side by side, one frame of each per
+# step. Without NumPy the same is done with a plain loop.
+
+import os
+import sys
+import array
+import struct
+import itertools
+import collections
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import metrics
+
+FRAME_SIZE = 16
+
+SAMPLES_PER_FRAME = 28
+
+# flags byte: the end frame of a sample, whether it then jumps back to the
+# loop start (rather than stopping), and the frame the loop starts at
+FLAG_END = 0x01
+FLAG_REPEAT = 0x02
+FLAG_LOOP_START = 0x04
+
+# a frame with all three flags and nothing but 0x77 for data is the usual end
+# of a one-shot sample, not a loop over that one frame
+TERMINATOR_FLAGS = FLAG_END | FLAG_REPEAT | FLAG_LOOP_START
+TERMINATOR_DATA = b"\x77" * (FRAME_SIZE - 2)
+
+# prediction coefficients (in 64ths) of the previous two samples; filters
+# past 4 are not defined and predict nothing
+FILTERS = ((0, 0), (60, 0), (115, -52), (98, -55), (122, -60))
+
+DEFAULT_SAMPLE_RATE = 44100
+
+# runs still being filtered side by side below this are finished one by one
+MIN_LANES = 16
+
+VAG_ID = b"VAGp"
+VAG_HEADER_SIZE = 0x30
+
+VAB_ID = b"pBAV"
+
+Sample = collections.namedtuple("Sample", "offset size loop_start loop_end")
+
+USAGE = """Usage: %s [-r <sample_rate>] <BD|VAB|VAG> [...]
+
+  -r  sample rate of banks that do not say (default: %d)
+
+Every sample of a .BD or .VAB bank is written to <bank>_NNNN.wav next to it,
+a .VAG file to <name>.wav. Looped samples get their loop points in a smpl
+chunk."""
+
+def get_shift_filter(header):
+    shift = header & 0xF
+    # the SPU treats shifts past 12 as 9
+    if shift > 12:
+        shift = 9
+    index = header >> 4
+    return shift, FILTERS[index] if index < len(FILTERS) else FILTERS[0]
+
+def make_nibble_tables():
+    # per shift: byte -> (low nibble, high nibble), sign-extended and scaled
+    tables = []
+    for shift in range(13):
+        scaled = [((nibble << 12) - ((nibble & 8) << 13)) >> shift for nibble in range(16)]
+        tables.append([(scaled[byte & 0xF], scaled[byte >> 4]) for byte in range(256)])
+    return tables
+
+nibble_tables = make_nibble_tables()
+
+def filter_frame(xs, c1, c2, h1, h2, out):
+    for s in xs:
+        s += (h1 * c1 + h2 * c2) >> 6
+        if s > 32767:
+            s = 32767
+        elif s < -32768:
+            s = -32768
+        out.append(s)
+        h2 = h1
+        h1 = s
+    return h1, h2
+
+def decode_frames_python(data, resets):
+    out = array.array("h")
+    h1 = h2 = 0
+    for frame in range(len(data) // FRAME_SIZE):
+        base = frame * FRAME_SIZE
+        if frame in resets:
+            h1 = h2 = 0
+        shift, (c1, c2) = get_shift_filter(data[base])
+        table = nibble_tables[shift]
+        xs = list(itertools.chain.from_iterable(map(table.__getitem__, data[base+2:base+FRAME_SIZE])))
+        if c1 == 0 and c2 == 0:
+            out.extend(xs)
+            h1, h2 = xs[-1], xs[-2]
+        else:
+            h1, h2 = filter_frame(xs, c1, c2, h1, h2, out)
+    if sys.byteorder != "little":
+        out.byteswap()
+    return out.tobytes()
+
+def decode_frames_numpy(data, resets):
+    num_frames = len(data) // FRAME_SIZE
+    frames = numpy.frombuffer(data, numpy.uint8, num_frames * FRAME_SIZE).reshape(num_frames, FRAME_SIZE)
+
+    shift = frames[:, 0] & 0xF
+    shift[shift > 12] = 9
+    index = frames[:, 0] >> 4
+    index[index >= len(FILTERS)] = 0
+    coefs = numpy.array(FILTERS, numpy.int64)
+    c1 = coefs[index, 0]
+    c2 = coefs[index, 1]
+
+    # shifting into the top of an int16 sign-extends the nibble
+    nibbles = numpy.empty((num_frames, SAMPLES_PER_FRAME), numpy.int16)
+    nibbles[:, 0::2] = frames[:, 2:] & 0xF
+    nibbles[:, 1::2] = frames[:, 2:] >> 4
+    out = (nibbles << 12).astype(numpy.int64) >> shift[:, None].astype(numpy.int64)
+    del nibbles
+
+    # filter 0 frames are final already; every run of other frames starts
+    # from the end of the frame before it, or from silence at a reset
+    reset = numpy.zeros(num_frames, bool)
+    # empty samples at the end start no frame
+    reset[sorted(frame for frame in resets if frame < num_frames)] = True
+    reset[:1] = True
+    dependent = index != 0
+    after = numpy.concatenate((reset[1:], [True])) | ~numpy.concatenate((dependent[1:], [False]))
+    before = reset | ~numpy.concatenate(([False], dependent[:-1]))
+    starts = numpy.flatnonzero(dependent & before)
+    lengths = numpy.flatnonzero(dependent & after) - starts + 1
+
+    # longest first, so the runs still going at any step are a prefix
+    order = numpy.argsort(-lengths, kind="stable")
+    starts = starts[order]
+    lengths = lengths[order]
+    h1 = numpy.where(reset[starts], 0, out[starts - 1, -1])
+    h2 = numpy.where(reset[starts], 0, out[starts - 1, -2])
+
+    step = 0
+    lanes = len(starts)
+    while lanes >= MIN_LANES:
+        h1 = h1[:lanes]
+        h2 = h2[:lanes]
+        frame = starts[:lanes] + step
+        a = c1[frame]
+        b = c2[frame]
+        xs = out[frame]
+        for i in range(SAMPLES_PER_FRAME):
+            s = xs[:, i] + ((a * h1 + b * h2) >> 6)
+            numpy.clip(s, -32768, 32767, out=s)
+            xs[:, i] = s
+            h2 = h1
+            h1 = s
+        out[frame] = xs
+        step += 1
+        lanes = int(numpy.searchsorted(-lengths, -step))
+
+    # the few longest runs left are quicker one by one
+    for lane in range(lanes):
+        x1 = int(h1[lane])
+        x2 = int(h2[lane])
+        for frame in range(int(starts[lane]) + step, int(starts[lane] + lengths[lane])):
+            pcm = []
+            x1, x2 = filter_frame(out[frame].tolist(), int(c1[frame]), int(c2[frame]), x1, x2, pcm)
+            out[frame] = pcm
+
+    return out.astype("<i2").tobytes()
+
+def decode_frames(data, resets=()):
+    # data is a whole number of frames; the prediction starts from silence
+    # at the first frame and at every frame index in resets
+    resets = set(resets)
+    if numpy is not None:
+        return decode_frames_numpy(data, resets)
+    return decode_frames_python(data, resets)
+
+def is_terminator(data, pos):
+    return data[pos+1] == TERMINATOR_FLAGS and data[pos+2:pos+FRAME_SIZE] == TERMINATOR_DATA
+
+def scan_sample(data, offset, size):
+    # the sample ends with the first frame flagged as its end, if any, and
+    # loops (to its last loop start) if that frame says so
+    end = offset + size - size % FRAME_SIZE
+    loop_start = None
+    for pos in range(offset, end, FRAME_SIZE):
+        flags = data[pos+1]
+        if is_terminator(data, pos):
+            end = pos + FRAME_SIZE
+            break
+        if flags & FLAG_LOOP_START:
+            loop_start = pos
+        if flags & FLAG_END:
+            end = pos + FRAME_SIZE
+            if flags & FLAG_REPEAT and loop_start is not None:
+                return Sample(offset, end - offset,
+                              (loop_start - offset) // FRAME_SIZE * SAMPLES_PER_FRAME,
+                              (end - offset) // FRAME_SIZE * SAMPLES_PER_FRAME)
+            break
+    return Sample(offset, end - offset, None, None)
+
+def find_samples(data):
+    # a headerless bank (.BD): samples follow each other, each up to its end frame
+    samples = []
+    offset = 0
+    while len(data) - offset >= FRAME_SIZE:
+        sample = scan_sample(data, offset, len(data) - offset)
+        # a terminator after a sample that already ended is not one of its own
+        if sample.size > FRAME_SIZE or not is_terminator(data, offset):
+            samples.append(sample)
+        offset += sample.size
+    return samples
+
+def vab_samples(data):
+    # program and tone attributes, then a table of sizes (in 8-byte units)
+    # of up to 255 samples, then the samples
+    num_programs, num_samples = struct.unpack_from("<H2xH", data, 0x12)
+    table_offset = 0x20 + 128 * 0x10 + num_programs * 16 * 0x20
+    if table_offset + 256 * 2 > len(data):
+        raise ValueError("Truncated VAB header")
+    sizes = struct.unpack_from("<256H", data, table_offset)
+    samples = []
+    offset = table_offset + 256 * 2
+    for size in sizes[1:num_samples+1]:
+        size = min(size << 3, len(data) - offset)
+        samples.append(scan_sample(data, offset, size))
+        offset += size
+    return samples
+
+def decode_samples(data, samples):
+    # all samples in one go, each from silence; returns their PCM data
+    # (16-bit little-endian) in order
+    resets = []
+    num_frames = 0
+    for sample in samples:
+        resets.append(num_frames)
+        num_frames += sample.size // FRAME_SIZE
+    frames = b"".join(data[sample.offset:sample.offset+sample.size] for sample in samples)
+    pcm = decode_frames(frames, resets)
+    frame_size = SAMPLES_PER_FRAME * 2
+    pcms = []
+    for sample, start in zip(samples, resets):
+        pcms.append(pcm[start*frame_size:(start + sample.size // FRAME_SIZE)*frame_size])
+    return pcms
+
+def make_wav(pcm, rate, loop_start=None, loop_end=None):
+    chunks = [
+        struct.pack("<4sI4s4sIHHIIHH", b"RIFF", 0, b"WAVE", b"fmt ", 16, 1, 1, rate, rate * 2, 2, 16),
+        struct.pack("<4sI", b"data", len(pcm)),
+        pcm,
+    ]
+    if loop_start is not None:
+        # one forward loop; its end is the last sample played
+        chunks.append(struct.pack("<4sI9I6I", b"smpl", 60,
+                                  0, 0, 1000000000 // rate, 60, 0, 0, 0, 1, 0,
+                                  0, 0, loop_start, loop_end - 1, 0, 0))
+    wav = b"".join(chunks)
+    return wav[:4] + struct.pack("<I", len(wav) - 8) + wav[8:]
+
+def get_bank(data, rate):
+    # (samples, sample rate, whether the file is a single sample)
+    if data[:4] == VAG_ID:
+        size, header_rate = struct.unpack_from(">2I", data, 0x0C)
+        sample = scan_sample(data, VAG_HEADER_SIZE, min(size, len(data) - VAG_HEADER_SIZE))
+        return [sample], header_rate or rate, True
+    if data[:4] == VAB_ID:
+        return vab_samples(data), rate, False
+    return find_samples(data), rate, False
+
+def convert(path, rate=DEFAULT_SAMPLE_RATE):
+    with metrics.open_file(path, "rb") as f:
+        data = f.read()
+
+    with metrics.phase("scan"):
+        samples, rate, single = get_bank(data, rate)
+
+    with metrics.phase("decode"):
+        pcms = decode_samples(data, samples)
+
+    stem = os.path.splitext(path)[0]
+    outpaths = []
+    for index, (sample, pcm) in enumerate(zip(samples, pcms)):
+        outpath = "%s.wav" % stem if single else "%s_%04d.wav" % (stem, index)
+        wav = make_wav(pcm, rate, sample.loop_start, sample.loop_end)
+        with metrics.member(outpath, len(wav)), metrics.open_file(outpath, "wb") as f:
+            f.write(wav)
+        outpaths.append(outpath)
+    return outpaths
+
+def main(argc=len(sys.argv), argv=sys.argv):
+    args = argv[1:argc]
+    rate = DEFAULT_SAMPLE_RATE
+
+    if len(args) >= 2 and args[0] == "-r":
+        rate = int(args[1])
+        args = args[2:]
+
+    if not args or rate <= 0:
+        print(USAGE % (argv[0], DEFAULT_SAMPLE_RATE))
+        return 1
+
+    for path in args:
+        if not os.path.isfile(path):
+            print("ERROR: Invalid file path: %s" % path)
+            continue
+        try:
+            outpaths = convert(os.path.realpath(path), rate)
+        except (ValueError, struct.error) as e:
+            print("ERROR: %s: %s" % (path, e))
+            continue
+        print("%s: %d samples" % (path, len(outpaths)))
+
+    return 0
+
+if __name__ == "__main__":
+    main()